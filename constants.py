@@ -1,29 +1,40 @@
 # Disk-specific constants
-BLOCKSIZE           =   256     # Block size statically defined as 256 bytes
+BLOCKSIZE           =   256     # Default block size, each FS records its own in the superblock (see tfs_mkfs)
+MIN_BLOCKSIZE       =   256     # Block sizes are powers of 2 in [MIN_BLOCKSIZE, MAX_BLOCKSIZE]
+MAX_BLOCKSIZE       =   65536
 DEFAULT_DISK_SIZE   =   10240   # Default size of a disk if no other size specified
+DEFAULT_CACHE_BLOCKS =  64      # Default number of blocks held by a disk's LRU block cache (0 disables it)
+WRITE_BUFFER_BLOCKS =   16      # Data blocks an open file buffers small writes in before they're flushed
+READAHEAD_MIN_BLOCKS =  2       # Read-ahead window of an open file after open/a random seek
+READAHEAD_MAX_BLOCKS =  64      # ^^^ Largest the window grows to (doubling) while reads stay sequential
+ASYNC_WORKERS       =   4       # Worker threads an AsyncTinyFS runs its operations (and their block I/O) on
+DIRTY_BACKGROUND_BYTES = 262144 # A write-back disk's flusher thread starts writing back once this much is dirty,
+DIRTY_EXPIRE        =   0.5     # ^^^ or once its oldest dirty block has been dirty this many seconds
+DIRTY_LIMIT_BYTES   =   1048576 # ^^^ Writers wait for the flusher while this much is dirty
 
 # tinyFS-specific constants
 DEFAULT_DISK_NAME   =   "tinyFSDisk"
 MAGIC_NUMBER        =   0x5A
 NAME_SIZE           =   8       # Name is 8 chars/bytes in length
 ADDR_SIZE           =   4
-ROOT_DIR_BLOCK      =   3       # See tinyFS.py for details on FS block layout
-HEADER_BYTES        =   3       # ^^^ Number of header bytes in superblock
-BITMAP_BLOCKS       =   2       # ^^^ Number of extra blocks for freeblock bitmap
-INODE_TABLE_SIZE    =   5       # ^^^ Number of blocks for Inode Table size
-DATA_REGION_START   =   8       # ^^^
-MAX_DBLOCKS         =   59      # Max number of data blocks for a file, dictated by INode's space for data block list
-INODE_METADATA      =   20      # Number of bytes needed for file metadata, before block location list
-                                #   2 bytes for file type, 
+INODE_TABLE_SIZE    =   5       # Number of blocks the Inode Table starts out with and grows by (see libTinyFS.py
+                                #   for the FS block layout, SUPERBLOCK_HEADER for the superblock)
+BITMAP_SCAN_BYTES   =   8       # Freeblock bitmap is scanned a word (this many bytes) at a time
+ALLOC_SEARCH_RUNS   =   64      # Free runs alloc_extents looks at for one that fits a whole request
+JOURNAL_BLOCKS      =   256     # Largest journal region tfs_mkfs gives an FS (smaller disks get 1/32 of their blocks)
+JOURNAL_MIN_BLOCKS  =   16      # ^^^ Disks that would get fewer get no journal at all
+JOURNAL_COMMIT_WINDOW = 0.005   # Seconds a journal transaction collects operations before it's committed (one fsync)
+JOURNAL_MAGIC       =   0x544A524E  # Marks every journal block (see JOURNAL_BLOCK in libTinyFS.py)
+INODE_METADATA      =   24      # Number of bytes needed for file metadata, before block location list
+                                #   1 byte for perms, 1 for file type, 2 for flags,
                                 #   4 for size, 
-                                #   2 for blocks allocated
+                                #   4 for blocks allocated
                                 #   12 (4 each) for access, creation, and modification times,
-MAX_FILESIZE        =   59 * BLOCKSIZE
-INODE_ENTRY_SIZE    =   12      # 4 bytes for block number, 8 for name
+INODE_ENTRY_SIZE    =   12      # 4 bytes for block number, 8 for name (directory entries: 8 for name, 4 for slot)
 INODE_SIZE_TIME     =   4       # Number of bytes used to store time
 INODE_SIZE_TYPE     =   1
 INODE_SIZE_PERMS    =   1
-INODE_SIZE_FILESIZE =   2
+INODE_SIZE_FILESIZE =   4
 INODE_SIZE_NBLOCKS  =   4
 
 # File types/modes
@@ -31,6 +42,25 @@ MODE_SB     =   0
 MODE_DIR    =   1
 MODE_DATA   =   2
 
+# Journal block types
+JBLOCK_HEADER       =   0       # First journal block: tid of the first transaction to replay
+JBLOCK_DESCRIPTOR   =   1       # Block numbers of the block images that follow it
+JBLOCK_REVOKE       =   2       # Block numbers whose earlier images must not be replayed
+JBLOCK_COMMIT       =   3       # Ends a transaction, with a checksum over its blocks
+
+# Inode flags
+INODE_FLAG_INLINE   =   0x0001  # File data is stored in the inode block itself, after INODE_METADATA
+
+# Block cache write policies
+CACHE_WRITE_THROUGH =   0       # Writes go to the cache and straight to disk
+CACHE_WRITE_BACK    =   1       # Writes stay dirty in the cache until flushed/evicted
+
+# Access time policies (per mount)
+ATIME_STRICT        =   0       # Write atime (and mtime) to the inode on every access
+ATIME_RELATIME      =   1       # Only update atime if older than mtime or than RELATIME_MAX_AGE
+ATIME_NOATIME       =   2       # Never update atime on reads
+RELATIME_MAX_AGE    =   86400   # Default relatime age in seconds (1 day)
+
 # File perms
 PERMS_RW    =   0
 PERMS_RO    =   1
@@ -56,15 +86,20 @@ ERR_FILE_TOO_LARGE  =   -16
 ERR_NO_FD           =   -17
 ERR_FILE_NOT_FOUND  =   -18
 ERR_INVALID_PERMS   =   -19
+ERR_INVALID_NAME    =   -20
+ERR_INVALID_BLOCKSIZE = -21
+ERR_NOT_DIR         =   -22
+ERR_IS_DIR          =   -23
+ERR_DIR_NOT_EMPTY   =   -24
 
 # Indexing into inode block (array of bytes)
 INODE_PERMS         =   0
 INODE_TYPE          =   1
-INODE_FILESIZE      =   2
-INODE_NBLOCKS       =   4
-INODE_CTIME         =   8
-INODE_ATIME         =   12
-INODE_MTIME         =   16
+INODE_FILESIZE      =   4
+INODE_NBLOCKS       =   8
+INODE_CTIME         =   12
+INODE_ATIME         =   16
+INODE_MTIME         =   20
 
 # Indexing into inode_entry (name, index)
 INODE_ENTRY_NAME    =   0
@@ -1,37 +1,272 @@
 #!/usr/bin/env python3
 from constants import *
+from collections import OrderedDict
+import atexit
 import binascii
+import mmap
+import os
+import threading
 import time
 
+class CountingLock():
+    # Mutex that counts how often it was taken and how often a thread had to wait for it (contention)
+    def __init__(self, reentrant=False):
+        self.lock = threading.RLock() if reentrant else threading.Lock()
+        self.acquires = 0
+        self.contended = 0
+
+    def acquire(self):
+        waited = not self.lock.acquire(blocking=False)
+        if(waited):
+            self.lock.acquire()
+            self.contended += 1
+        self.acquires += 1
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class BlockCache():
+    # LRU cache of whole blocks sitting in front of a disk's backing file
+    def __init__(self, capacity, mode):
+        self.capacity = capacity            # Max number of blocks held
+        self.mode = mode                    # CACHE_WRITE_THROUGH or CACHE_WRITE_BACK
+        self.blocks = OrderedDict()         # bNum -> bytearray, least recently used first
+        self.dirty = {}                     # bNum -> generation, for blocks that differ from what's on disk
+                                            #   (write-back only)
+        self.generation = 0                 # ^^^ bumped by every write, so a write-back knows if it's still current
+        self.dirtySince = None              # When the oldest dirty block (roughly) got dirty
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def get(self, bNum):
+        # Returns cached block (and marks it most recently used), or None on a miss
+        block = self.blocks.get(bNum)
+        if(block is None):
+            self.misses += 1
+            return None
+        self.blocks.move_to_end(bNum)
+        self.hits += 1
+        return block
+
+    def put(self, disk, bNum, block, dirty):
+        # Inserts/replaces a block, evicting (and writing back) the LRU block(s) if over capacity
+        self.blocks[bNum] = block
+        self.blocks.move_to_end(bNum)
+        if(dirty):
+            if(len(self.dirty) == 0):
+                self.dirtySince = time.monotonic()
+            self.dirty[bNum] = self.generation
+            self.generation += 1
+            if((disk.flusher is not None) and (len(self.dirty) in (1, disk.dirtyBackground))):
+                disk.flushed.notify_all()   # Wake the flusher (to time the first dirty block, or to start now)
+        self.evict(disk)
+
+    def fill(self, disk, bNum, block):
+        # Caches a clean block just read from disk, unless a (newer) copy got cached while it was being read
+        if(bNum not in self.blocks):
+            self.blocks[bNum] = block
+            self.evict(disk)
+
+    def evict(self, disk):
+        # Drops (and writes back) least recently used blocks until the cache is within capacity
+        # With a flusher, dirty blocks are left to it and don't count towards capacity (DIRTY_LIMIT_BYTES
+        #   bounds them). They, and ones being written back right now, go to the most recently used end instead.
+        flusher = (disk.flusher is not None)
+        skipped = 0
+        while(((len(self.blocks) - (len(self.dirty) if flusher else 0)) > self.capacity) and
+                (skipped < len(self.blocks))):
+            oldNum, oldBlock = self.blocks.popitem(last=False)
+            if(oldNum in self.dirty):
+                if(flusher or (oldNum in disk.flushing)):
+                    self.blocks[oldNum] = oldBlock
+                    skipped += 1
+                    continue
+                del self.dirty[oldNum]
+                disk.pwrite(oldBlock, oldNum*disk.blockSize)
+                self.writebacks += 1
+            self.evictions += 1
+
+class PendingRead():
+    # A block read in progress, which other threads that need the same block wait for instead of reading it again
+    __slots__ = ('data', 'event')
+
+    def __init__(self):
+        self.data = None                    # Block contents, once read (only kept if anyone waits for it)
+        self.event = None                   # Created by the first thread to wait, set when data is there
+
 class Disk():
-    def __init__(self, file, size):
+    def __init__(self, file, size, cacheBlocks=0, cacheMode=CACHE_WRITE_THROUGH, mapped=False, blockSize=BLOCKSIZE,
+            flusher=False):
         self.disk = file
+        self.fd = file.fileno()             # All block I/O is positional (pread/pwrite) on the raw fd
         self.size = size
         self.open = OPEN
-        self.numBlocks = int(size / BLOCKSIZE)
+        self.blockSize = blockSize          # Bytes per block, fixed for the life of the open disk
+        self.numBlocks = int(size / blockSize)
+        self.cache = None
+        self.lock = CountingLock()          # Guards the block cache and pending (reads themselves run without it)
+        self.pending = {}                   # bNum -> PendingRead, blocks being read right now
+        self.shared = 0                     # Block reads saved by waiting for another thread's read
+        self.held = {}                      # bNum -> newest contents of a block not written in place yet, see
+                                            #   holdBlocks (guarded by lock too)
+        self.map = None                     # mmap of the whole backing file (mapped disks only)
+        self.view = None                    # memoryview over self.map, sliced per block
+        self.flusher = None                 # Write-back thread (write-back caches only, see flushRun)
+        self.flushed = threading.Condition(self.lock.lock)    # Write-backs finished/flusher has work
+        self.flushing = set()               # bNums being written back right now (without holding lock)
+        self.dirtyBackground = max(int(DIRTY_BACKGROUND_BYTES / blockSize), 1)   # In blocks
+        self.dirtyLimit = max(int(DIRTY_LIMIT_BYTES / blockSize), 1)
+        self.closing = False                # Stops the flusher
+        self.flushes = 0                    # Write-back rounds
+        self.throttled = 0                  # Writes that had to wait for the flusher
+        if(mapped):
+            # The mapping already is the page cache, so mapped disks skip the block cache
+            self.map = mmap.mmap(file.fileno(), size)
+            self.view = memoryview(self.map)
+        elif(cacheBlocks > 0):
+            self.cache = BlockCache(cacheBlocks, cacheMode)
+            if(flusher and (cacheMode == CACHE_WRITE_BACK)):
+                self.flusher = threading.Thread(target=flushRun, args=(self,), name="disk-flusher", daemon=True)
+                self.flusher.start()
+
+    def pread(self, buf, offset):
+        # Fills buf (a writable byte memoryview) straight from the disk at byte offset, bypassing the cache
+        # One positional syscall, no seek and no intermediate buffer
+        if(self.view is not None):
+            buf[:] = self.view[offset:offset+len(buf)]
+            return len(buf)
+        if(HAVE_PREADV):
+            return os.preadv(self.fd, [buf], offset)
+        data = os.pread(self.fd, len(buf), offset)
+        buf[:len(data)] = data
+        return len(data)
+
+    def pwrite(self, data, offset):
+        # Writes any bytes-like object straight to the disk at byte offset, bypassing the cache
+        if(self.view is not None):
+            self.view[offset:offset+len(data)] = data
+            return len(data)
+        return os.pwrite(self.fd, data, offset)
+
+    def preadv(self, bufs, offset):
+        # Fills each buffer in bufs in turn from consecutive bytes starting at offset (one syscall per IOV_MAX buffers)
+        if((self.view is not None) or (not HAVE_PREADV)):
+            for buf in bufs:
+                self.pread(buf, offset)
+                offset += len(buf)
+            return
+        for i in range(0, len(bufs), IOV_MAX):
+            chunk = bufs[i:i+IOV_MAX]
+            os.preadv(self.fd, chunk, offset)
+            offset += sum(len(buf) for buf in chunk)
+
+    def pwritev(self, datas, offset):
+        # Writes each bytes-like object in datas back to back starting at offset (one syscall per IOV_MAX buffers)
+        if((self.view is not None) or (not HAVE_PWRITEV)):
+            for data in datas:
+                self.pwrite(data, offset)
+                offset += len(data)
+            return
+        for i in range(0, len(datas), IOV_MAX):
+            chunk = datas[i:i+IOV_MAX]
+            os.pwritev(self.fd, chunk, offset)
+            offset += sum(len(data) for data in chunk)
+
+    def sync(self):
+        # Pushes everything written so far down to stable storage (msync for mapped disks, fsync otherwise)
+        if(self.map is not None):
+            self.map.flush()
+        else:
+            os.fsync(self.fd)
+
+    def release(self):
+        # Stops the flusher, tears down the mapping (if any) and closes the backing file
+        if(self.flusher is not None):
+            with self.lock:
+                self.closing = True
+                self.flushed.notify_all()
+            self.flusher.join()
+        if(self.map is not None):
+            self.view.release()
+            self.map.close()
+            self.view = None
+            self.map = None
+        self.disk.close()
 
 disks = []  # Will hold all the disks as tuples (filename, open)
+disks_lock = threading.Lock()   # Disks can be opened from several threads (one per mounted FS)
+HAVE_PREADV = hasattr(os, 'preadv')     # Not available everywhere (e.g. older macOS)
+HAVE_PWRITEV = hasattr(os, 'pwritev')
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')  # Most buffers a single preadv/pwritev accepts
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if(IOV_MAX <= 0):
+    IOV_MAX = 1024
+
+def blockView(block):
+    # Wraps any buffer-protocol object as a flat byte memoryview without copying it
+    # Returns None for objects that don't support the buffer protocol (e.g. plain lists)
+    try:
+        view = memoryview(block)
+    except TypeError:
+        return None
+    if(view.format != 'B' or view.ndim != 1):
+        view = view.cast('B')
+    return view
 
-def openDisk(filename, nBytes):
+def openDisk(filename, nBytes, cacheBlocks=DEFAULT_CACHE_BLOCKS, cacheMode=CACHE_WRITE_THROUGH, cacheBytes=None, mapped=False,
+        preallocate=False, blockSize=BLOCKSIZE, flusher=False):
+    # cacheBlocks/cacheBytes bound the disk's LRU block cache by block count or by bytes (cacheBytes wins if given)
+    # flusher=True (write-back caches) writes dirty blocks back from a thread of their own, see flushRun
+    # mapped=True serves blocks out of an mmap of the file instead (see openDiskMapped)
+    # preallocate=True reserves the new disk's space up front (posix_fallocate) instead of leaving it sparse
+    # blockSize sets how many bytes bNum addresses in every block read/write on this disk
     if(nBytes < 0):                     # nBytes must be >= 0
         return ERR_DSKSIZE
     elif(nBytes == 0):                  # Open existing disk without overwriting anything
         try:                            # Try opening for reading & writing
-            disk = open(filename, 'r+b')
+            disk = open(filename, 'r+b', buffering=0)
         except:
             return ERR_OPEN
     else:
         try:
-            # Create/Truncate new disk and initialize bytes to 0
-            disk = open(filename, 'w+b')
-            disk.write(b'\x00' * nBytes)   # Initialize all bytes to 0
+            # Create/Truncate new disk and size it: a sparse file that reads back as all 0's,
+            #   without ever building or writing nBytes of zeros
+            disk = open(filename, 'w+b', buffering=0)
+            os.ftruncate(disk.fileno(), nBytes)
+            if(preallocate and hasattr(os, 'posix_fallocate')):
+                os.posix_fallocate(disk.fileno(), 0, nBytes)
         except:
             return ERR_CREAT
-    disks.append(Disk(disk, nBytes))    # Add new disk to array as (filename=disk, open=1)
-    return len(disks)-1                 # Return index of new disk
+    if(nBytes == 0):                    # Existing disk, its size is whatever the file already holds
+        nBytes = os.fstat(disk.fileno()).st_size
+    if(cacheBytes is not None):
+        cacheBlocks = int(cacheBytes / blockSize)
+    try:
+        newDisk = Disk(disk, nBytes, cacheBlocks, cacheMode, mapped, blockSize, flusher)
+    except (ValueError, OSError):       # Can't map an empty file
+        disk.close()
+        return ERR_OPEN
+    with disks_lock:
+        disks.append(newDisk)           # Add new disk to array as (filename=disk, open=1)
+        return len(disks)-1             # Return index of new disk
+
+def openDiskMapped(filename, nBytes):
+    # Same as openDisk, but readBlock/writeBlock work on memoryview slices of an mmap of the disk
+    return openDisk(filename, nBytes, mapped=True)
 
 def readBlock(disk, bNum, block):
-    # Assumes block is a bytearray
+    # Fills block in place: anything writable that supports the buffer protocol (bytearray, memoryview, array)
     # Check that valid disk is selected
     if(disk > (len(disks)-1)):
         return ERR_INVALID_DISK
@@ -40,16 +275,31 @@ def readBlock(disk, bNum, block):
     if(bNum >= disks[disk].numBlocks):
         return ERR_INVALID_BNUM
     
-    # If open/valid, read block from disk
-    currDisk = disks[disk].disk
-    currDisk.seek(bNum*BLOCKSIZE)
-    inBlock = bytearray(currDisk.read(BLOCKSIZE))
-    for i in range(BLOCKSIZE):
-        block[i] = inBlock[i]
+    # Serve the block from the held blocks or the cache if possible
+    currDisk = disks[disk]
+    bs = currDisk.blockSize
+    cache = currDisk.cache
+    if((cache is not None) or currDisk.held):
+        with currDisk.lock:
+            cached = currDisk.held.get(bNum)
+            if((cached is None) and (cache is not None)):
+                cached = cache.get(bNum)
+            if(cached is not None):
+                block[:bs] = cached
+                return SUCCESS
+
+    # If open/valid, read block from disk directly into the caller's buffer
+    view = blockView(block)
+    if(view is None or view.readonly):      # e.g. a list, go through a scratch buffer
+        view = memoryview(bytearray(bs))
+        readShared(currDisk, [bNum], [view])
+        block[:bs] = view
+    else:
+        readShared(currDisk, [bNum], [view[:bs]])
     return SUCCESS
 
 def writeBlock(disk, bNum, block):
-    # Assumes block is bytearray
+    # Accepts any buffer-protocol object (only the first blockSize bytes are written), no copies made
     # Check that valid disk is selected
     if(disk > (len(disks)-1)):
         return ERR_INVALID_DISK
@@ -58,22 +308,369 @@ def writeBlock(disk, bNum, block):
     if(bNum >= disks[disk].numBlocks):
         return ERR_INVALID_BNUM
 
-    # If open/valid, write block to disk
-    currDisk = disks[disk].disk
-    buffer = bytearray(block)[:BLOCKSIZE]   # Cut to BLOCKSIZE bytes
-    currDisk.seek(bNum*BLOCKSIZE)           # Seek to correct logical block
-    currDisk.write(bytes(buffer))           # Write bytes to disk
+    currDisk = disks[disk]
+    bs = currDisk.blockSize
+    data = blockView(block)
+    if(data is None):
+        data = bytes(block)
+    data = data[:bs]                 # Cut to bs bytes
+    cache = currDisk.cache
+    if(cache is None):
+        currDisk.pwrite(data, bNum*bs)
+        dropPending(currDisk, [bNum])
+        return 0
+
+    # Cache keeps its own full copy of the block, short writes only replace the start of it
+    with currDisk.lock:
+        if(cache.mode == CACHE_WRITE_BACK):
+            throttleDirty(currDisk, bNum)
+        full = cache.blocks.get(bNum)
+        if(full is None):
+            full = bytearray(bs)
+            if(len(data) < bs):
+                currDisk.pread(memoryview(full), bNum*bs)
+        full[:len(data)] = data
 
+        if(cache.mode == CACHE_WRITE_BACK):     # Leave it dirty in the cache, flushDisk/closeDisk/eviction writes it
+            cache.put(currDisk, bNum, full, True)
+        else:                                   # Write-through: update cache and disk together
+            currDisk.pwrite(data, bNum*bs)
+            cache.put(currDisk, bNum, full, False)
+        currDisk.pending.pop(bNum, None)        # See dropPending
+        currDisk.held.pop(bNum, None)
     return 0
 
+def dropPending(currDisk, bNums):
+    # Blocks just written: reads of them still under way may return the old contents, so reads from now on must
+    #   not wait for those. A held copy of them is out of date too (see holdBlocks).
+    if((len(currDisk.pending) > 0) or (len(currDisk.held) > 0)):
+        with currDisk.lock:
+            for bNum in bNums:
+                currDisk.pending.pop(bNum, None)
+                currDisk.held.pop(bNum, None)
+
+def blockRuns(bNums):
+    # Sorts the positions of bNums by block number and groups them into runs of contiguous blocks
+    # Returns a list of (first block number, [positions in bNums]) in disk order
+    runs = []
+    for pos in sorted(range(len(bNums)), key=bNums.__getitem__):
+        bNum = bNums[pos]
+        if(runs and (bNum == runs[-1][0] + len(runs[-1][1]))):
+            runs[-1][1].append(pos)
+        else:
+            runs.append((bNum, [pos]))
+    return runs
+
+def readBlocks(disk, bNums, buf):
+    # Vectored readBlock: block bNums[i] lands in buf[i*blockSize:(i+1)*blockSize]
+    # Blocks not in the cache are read with one preadv per run of contiguous block numbers
+    if(disk > (len(disks)-1)):
+        return ERR_INVALID_DISK
+    if(disks[disk].open == CLOSED):
+        return ERR_CLOSED
+    currDisk = disks[disk]
+    bs = currDisk.blockSize
+    for bNum in bNums:
+        if(bNum >= currDisk.numBlocks):
+            return ERR_INVALID_BNUM
+
+    view = blockView(buf)
+    cache = currDisk.cache
+    misses = []                             # Positions (in bNums) that have to come off the disk
+    if((cache is None) and (not currDisk.held)):
+        misses = list(range(len(bNums)))
+    else:
+        with currDisk.lock:
+            for pos in range(len(bNums)):
+                cached = currDisk.held.get(bNums[pos])
+                if((cached is None) and (cache is not None)):
+                    cached = cache.get(bNums[pos])
+                if(cached is None):
+                    misses.append(pos)
+                else:
+                    view[pos*bs:(pos+1)*bs] = cached
+
+    readShared(currDisk, [bNums[pos] for pos in misses], [view[pos*bs:(pos+1)*bs] for pos in misses])
+    return SUCCESS
+
+def readShared(currDisk, bNums, bufs):
+    # Reads block bNums[i] into bufs[i] (writable views) off the disk, and caches them
+    # Concurrent reads of the same block are done once: blocks another thread is reading right now are waited
+    #   for instead, and the ones read here go to whoever started waiting for them meanwhile
+    # Contiguous blocks read here go in one preadv each
+    if(currDisk.view is not None):          # Mapped: a read is just a copy out of the mapping
+        for i in range(len(bNums)):
+            currDisk.pread(bufs[i], bNums[i]*currDisk.blockSize)
+        return
+    bs = currDisk.blockSize
+    cache = currDisk.cache
+    lead = []                               # Positions read here, with their PendingRead
+    follow = []                             # ^^^ waited for
+    with currDisk.lock:
+        for i in range(len(bNums)):
+            pending = currDisk.pending.get(bNums[i])
+            if(pending is None):
+                pending = PendingRead()
+                currDisk.pending[bNums[i]] = pending
+                lead.append((i, pending))
+            else:
+                if(pending.event is None):
+                    pending.event = threading.Event()
+                follow.append((i, pending))
+                currDisk.shared += 1
+
+    leadNums = [bNums[i] for i, pending in lead]
+    for start, run in blockRuns(leadNums):
+        currDisk.preadv([bufs[lead[j][0]] for j in run], start*bs)
+    with currDisk.lock:
+        for i, pending in lead:
+            if((cache is not None) or (pending.event is not None)):
+                pending.data = bytearray(bufs[i])
+                if(cache is not None):
+                    cache.fill(currDisk, bNums[i], pending.data)
+            if(currDisk.pending.get(bNums[i]) is pending):
+                del currDisk.pending[bNums[i]]
+            if(pending.event is not None):
+                pending.event.set()
+    for i, pending in follow:
+        pending.event.wait()
+        bufs[i][:] = pending.data
+
+def writeBlocks(disk, bNums, buf):
+    # Vectored writeBlock: buf[i*blockSize:(i+1)*blockSize] is written to block bNums[i]
+    # Runs of contiguous block numbers go out in one pwritev (or sit dirty in a write-back cache)
+    if(disk > (len(disks)-1)):
+        return ERR_INVALID_DISK
+    if(disks[disk].open == CLOSED):
+        return ERR_CLOSED
+    currDisk = disks[disk]
+    bs = currDisk.blockSize
+    for bNum in bNums:
+        if(bNum >= currDisk.numBlocks):
+            return ERR_INVALID_BNUM
+
+    view = blockView(buf)
+    cache = currDisk.cache
+    if(cache is None):
+        for start, run in blockRuns(bNums):
+            currDisk.pwritev([view[pos*bs:(pos+1)*bs] for pos in run], start*bs)
+        dropPending(currDisk, bNums)
+        return SUCCESS
+
+    with currDisk.lock:
+        if(cache.mode == CACHE_WRITE_BACK):
+            for pos in range(len(bNums)):
+                throttleDirty(currDisk, bNums[pos])
+                cache.put(currDisk, bNums[pos], bytearray(view[pos*bs:(pos+1)*bs]), True)
+        else:
+            for start, run in blockRuns(bNums):
+                datas = [view[pos*bs:(pos+1)*bs] for pos in run]
+                currDisk.pwritev(datas, start*bs)
+                for i in range(len(run)):
+                    cache.put(currDisk, start+i, bytearray(datas[i]), False)
+        for bNum in bNums:                  # See dropPending
+            currDisk.pending.pop(bNum, None)
+            currDisk.held.pop(bNum, None)
+    return SUCCESS
+
+def holdBlocks(disk, bNums, buf):
+    # Makes buf[i*blockSize:(i+1)*blockSize] the contents of block bNums[i] for every read from now on, without
+    #   writing it to the disk (yet): the caller logs it somewhere first, then has releaseBlocks write it in place
+    # A plain write of a held block replaces what's held (the held copy is dropped, not written)
+    # Returns the held copies, in bNums order (needed by releaseBlocks)
+    currDisk = disks[disk]
+    bs = currDisk.blockSize
+    view = blockView(buf)
+    copies = [bytearray(view[pos*bs:(pos+1)*bs]) for pos in range(len(bNums))]
+    with currDisk.lock:
+        cache = currDisk.cache
+        for pos in range(len(bNums)):
+            currDisk.held[bNums[pos]] = copies[pos]
+            currDisk.pending.pop(bNums[pos], None)
+            if(cache is not None):          # The held copy is newer than anything cached
+                cache.blocks.pop(bNums[pos], None)
+                cache.dirty.pop(bNums[pos], None)
+    return copies
+
+def releaseBlocks(disk, bNums, blocks):
+    # Writes blocks[i] (copies from holdBlocks) in place to block bNums[i], in contiguous runs in block order
+    # Blocks written over since they were held are skipped. A block held again since (with newer contents) still
+    #   gets blocks[i] written, but reads keep getting the newer held copy until that one is released.
+    currDisk = disks[disk]
+    bs = currDisk.blockSize
+    cache = currDisk.cache
+    with currDisk.lock:
+        waitFlushing(currDisk, bNums)
+        live = [pos for pos in range(len(bNums)) if(currDisk.held.get(bNums[pos]) is not None)]
+        liveNums = [bNums[pos] for pos in live]
+        for start, run in blockRuns(liveNums):
+            currDisk.pwritev([blocks[live[j]] for j in run], start*bs)
+        for pos in live:
+            if(currDisk.held[bNums[pos]] is blocks[pos]):
+                del currDisk.held[bNums[pos]]
+                if(cache is not None):
+                    cache.put(currDisk, bNums[pos], blocks[pos], False)
+    return SUCCESS
+
+def logBlocks(disk, start, blocks):
+    # Writes blocks back to back from block start straight to the disk (a write-back cache would keep them in
+    #   memory), dropping any cached copies. Meant for log records that have to be on disk at the next syncDisk.
+    currDisk = disks[disk]
+    bs = currDisk.blockSize
+    bNums = list(range(start, start + len(blocks)))
+    with currDisk.lock:                     # An older write-back of them mustn't land after this write
+        waitFlushing(currDisk, bNums)
+        if(currDisk.cache is not None):
+            for bNum in bNums:
+                currDisk.cache.dirty.pop(bNum, None)
+    currDisk.pwritev(blocks, start*bs)
+    with currDisk.lock:
+        for bNum in bNums:
+            currDisk.pending.pop(bNum, None)
+            currDisk.held.pop(bNum, None)
+            if(currDisk.cache is not None):
+                currDisk.cache.blocks.pop(bNum, None)
+                currDisk.cache.dirty.pop(bNum, None)
+    return SUCCESS
+
+def syncDisk(disk):
+    # Makes every write that reached the backing file so far durable (dirty cached blocks aren't written, see
+    #   flushDisk for that)
+    if(disk > (len(disks)-1)):
+        return ERR_INVALID_DISK
+    if(disks[disk].open == CLOSED):
+        return ERR_CLOSED
+    disks[disk].sync()
+    return SUCCESS
+
+def flushDisk(disk):
+    # Writes every dirty cached block back to disk (in block order) and makes it all durable (fsync)
+    # For mapped disks this is an msync of the whole mapping
+    if(disk > (len(disks)-1)):
+        return ERR_INVALID_DISK
+    if(disks[disk].open == CLOSED):
+        return ERR_CLOSED
+
+    currDisk = disks[disk]
+    cache = currDisk.cache
+    if(cache is not None):
+        # Everything dirtied before now, including blocks the flusher is writing back already
+        with currDisk.lock:
+            generation = cache.generation
+        while(True):
+            with currDisk.lock:
+                while(len(currDisk.flushing) > 0):
+                    currDisk.flushed.wait()
+                if(not any((dirtied < generation) for dirtied in cache.dirty.values())):
+                    break
+            writeDirty(currDisk)
+    currDisk.sync()
+    return SUCCESS
+
+def writeDirty(currDisk):
+    # Writes back the dirty cached blocks that aren't being written back already: in block number order
+    #   (elevator order), contiguous ones in one pwritev. The lock isn't held for the writes themselves.
+    # Blocks written again meanwhile stay dirty. Returns how many blocks were written.
+    bs = currDisk.blockSize
+    cache = currDisk.cache
+    with currDisk.lock:
+        started = time.monotonic()
+        bNums = sorted(bNum for bNum in cache.dirty if(bNum not in currDisk.flushing))
+        generations = [cache.dirty[bNum] for bNum in bNums]
+        copies = [bytes(cache.blocks[bNum]) for bNum in bNums]
+        currDisk.flushing.update(bNums)
+    try:
+        for start, run in blockRuns(bNums):
+            currDisk.pwritev([copies[pos] for pos in run], start*bs)
+    finally:
+        with currDisk.lock:
+            for pos in range(len(bNums)):
+                if(cache.dirty.get(bNums[pos]) == generations[pos]):
+                    del cache.dirty[bNums[pos]]
+            cache.writebacks += len(bNums)
+            currDisk.flushing.difference_update(bNums)
+            cache.dirtySince = started if(len(cache.dirty) > 0) else None     # Those got dirty since
+            currDisk.flushes += 1
+            currDisk.flushed.notify_all()
+    return len(bNums)
+
+def flushRun(currDisk):
+    # Flusher thread of a write-back disk: writes the dirty blocks back (see writeDirty) once there are
+    #   dirtyBackground of them, once the oldest is DIRTY_EXPIRE seconds old, or when writers are throttled
+    cache = currDisk.cache
+    while(True):
+        with currDisk.lock:
+            while(True):
+                if(currDisk.closing):
+                    return
+                dirty = len(cache.dirty) - len(currDisk.flushing)
+                if(dirty >= currDisk.dirtyBackground):
+                    break
+                if(dirty > 0):
+                    wait = cache.dirtySince + DIRTY_EXPIRE - time.monotonic()
+                    if(wait <= 0):
+                        break
+                    currDisk.flushed.wait(wait)
+                else:
+                    currDisk.flushed.wait()
+        writeDirty(currDisk)
+
+def throttleDirty(currDisk, bNum):
+    # Called with the disk's lock held before a write makes block bNum dirty: while the disk is at its dirty limit
+    #   the writer waits for the flusher (which is woken up) to write some back
+    if((currDisk.flusher is None) or (bNum in currDisk.cache.dirty)):    # Rewriting a dirty block adds nothing
+        return
+    if(len(currDisk.cache.dirty) >= currDisk.dirtyLimit):
+        currDisk.throttled += 1
+        while(len(currDisk.cache.dirty) >= currDisk.dirtyLimit):
+            currDisk.flushed.notify_all()
+            currDisk.flushed.wait()
+
+def waitFlushing(currDisk, bNums):
+    # Called with the disk's lock held before writing bNums straight to disk: waits for write-backs of any of
+    #   them under way, which would otherwise land after this write with older contents
+    while((len(currDisk.flushing) > 0) and any((bNum in currDisk.flushing) for bNum in bNums)):
+        currDisk.flushed.wait()
+
+@atexit.register
+def flushAll():
+    # Dirty blocks of write-back disks left open would be lost with the process (flusher threads don't outlive it)
+    for disk in range(len(disks)):
+        if((disks[disk].open != CLOSED) and (disks[disk].cache is not None) and (len(disks[disk].cache.dirty) > 0)):
+            flushDisk(disk)
+
+def cacheStats(disk):
+    # Returns the disk's block cache counters as a dict (None if the disk has no cache)
+    if(disk > (len(disks)-1)):
+        return ERR_INVALID_DISK
+    cache = disks[disk].cache
+    if(cache is None):
+        return None
+    return {
+        "hits": cache.hits,
+        "misses": cache.misses,
+        "evictions": cache.evictions,
+        "writebacks": cache.writebacks,
+        "cached": len(cache.blocks),
+        "dirty": len(cache.dirty),
+        "contended": disks[disk].lock.contended,
+        "shared": disks[disk].shared,
+        "flushes": disks[disk].flushes,
+        "throttled": disks[disk].throttled,
+    }
+
 def closeDisk(disk):
     # Make sure disk is valid/open
     if(disk > (len(disks)-1)):
         return ERR_INVALID_DISK
+    if(disks[disk].open == CLOSED):
+        return ERR_CLOSED
     
-    currDisk = disks[disk].disk
+    # Dirty blocks (or mapped pages) have to reach the disk before it goes away
+    flushDisk(disk)
     disks[disk].open = CLOSED
-    currDisk.close()
+    disks[disk].release()
+    return SUCCESS
     
 
 def main():
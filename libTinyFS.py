@@ -1,48 +1,148 @@
 #!/usr/bin/env python3
 from libDisk import *
-import globalVars
 from math import *
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import heapq
+import struct
 import time
+import zlib
 import os
 import sys
+import threading
 
 
 # Tracked by OS
 filesystems = {}    # Tracks all created FS's
-curr_FS = None      # Currently mounted filesystem
-mounted = False     # FS is currently mounted / not
+filesystems_lock = threading.Lock()     # Guards filesystems and each FS's mounted flag
+curr_FS = None      # Filesystem mounted with tfs_mount (see default_handle)
+mounted = False     # FS is currently mounted with tfs_mount / not
 
 # File system layout:
-# Block 0: Superblock
-# Blocks 1-2: Extra space for freeblock bitmap
-# Blocks 3-7: Space for Inode Table
-# Blocks > 7: Data Region
-
-# Limitations
-# FS must be at least 2560 bytes (10 blocks, 8 needed for FS metadata, 2 for an inode and 1-block file)
-# FS must be at most 1568768 bytes (8 blocks for metadata, then entire freeblock bitmap is full) 
-# Files must be at least 256 bytes and at most 15104 bytes (full INode data block list)
+# Block 0: Superblock (header only, see SUPERBLOCK_HEADER)
+# Blocks 1 to B: Freeblock bitmap, one bit per block on the disk (B = nBlocks / bits per block, rounded up)
+# Next INODE_TABLE_SIZE blocks: Space for Inode Table (slot -> name, inode block; a file's FD is its slot)
+#   Each table block ends with the block number of the next one (0 = last). When every slot is taken the table
+#   grows by INODE_TABLE_SIZE more blocks from the data region, chained on at the end, so slots never move.
+# Next J blocks: Journal of metadata block images (J is in the superblock, 0 = no journal, see Journal)
+# Rest of the disk: Data Region, starting with the root directory's inode and its first bucket block
+
+# Directories are MODE_DIR inodes whose data blocks are hash buckets of (name, slot) entries: a name lives in
+#   bucket crc32(name) mod (number of buckets). A full bucket doubles the bucket count and rehashes the entries.
+#   Paths are '/'-separated names (at most NAME_SIZE bytes each) from the root directory.
+
+# Limitations (for the default 256 byte blocks, all of these scale with the FS's block size)
+# FS must be at least 2560 bytes (10 blocks: 7 for FS metadata on the smallest disks, 2 for the root directory
+#   and 1 free)
+# FS must have fewer than 2^32 blocks (block numbers are 4 bytes)
+# Files can be at most FS.max_filesize bytes (56 direct, 64 single indirect and 64*64 double indirect data
+#   blocks); small ones are stored inline in their inode and take no data blocks
 
 # Filesystem object
 class FS:
-    def __init__(self, nBytes, disk):
+    def __init__(self, nBytes, disk, block_size=BLOCKSIZE, journal_blocks=None):
         self.mounted = False
-        self.nBlocks = int(nBytes / BLOCKSIZE)
+        self.block_size = block_size
+        self.nBlocks = int(nBytes / block_size)
         self.disk = disk
         self.files = {}
-        self.extra_blocks = 0
-        self.free_blocks = self.nBlocks - 8 # First 8 blocks are for tracking FS metadata
-
-        # Number of bits per address / bits per byte = bytes per address
-        self.addr_size = int(ceil(ceil(log(self.nBlocks, 2)) / float(8)))
+        self.slots = {}                     # FD/inode table slot -> (name, inode block), built by index_load
+        self.free_slots = []                # Heap of free inode table slots
+        # Disk layout, sized from the disk: the bitmap has one bit for every block
+        self.bitmap_blocks = int(ceil(self.nBlocks / float(8*block_size)))
+        self.table_start = 1 + self.bitmap_blocks           # First inode table block
+        if(journal_blocks is None):                         # Journal: 1/32 of the disk, up to JOURNAL_BLOCKS
+            journal_blocks = min(int(self.nBlocks / 32), JOURNAL_BLOCKS)
+            if(journal_blocks < JOURNAL_MIN_BLOCKS):
+                journal_blocks = 0
+        self.journal_start = self.table_start + INODE_TABLE_SIZE
+        self.journal_blocks = journal_blocks
+        self.data_start = self.journal_start + journal_blocks
+        self.table_blocks = list(range(self.table_start, self.journal_start))  # Inode table blocks, in slot order
+        self.root = self.data_start                         # Root directory's inode block
+        self.free_blocks = max(self.nBlocks - self.data_start - 2, 0)
+        self.inodes = {}                    # Inode cache: inode block number -> Inode, for the current mount
+        self.atime_policy = ATIME_STRICT    # Set per mount, see tfs_mount
+        self.relatime_age = RELATIME_MAX_AGE
+        self.journal = None                 # Journal, while mounted (if the FS has a journal region)
+
+        # Resident copy of the freeblock bitmap (bit k = block k, 1 = free)
+        self.bitmap = bytearray()
+        self.bitmap_summary = []            # Summary levels over the bitmap, see summary_build
+        self.bitmap_cursor = 0              # Next-fit: bit to start the next free block search at
+        self.bitmap_dirty = set()           # Bitmap blocks (0 = first bitmap block) changed since the last bitmap_sync
+
+        # Layout values derived from the block size
+        self.ptrs_per_block = int(block_size / ADDR_SIZE)           # Block numbers held by one indirect block
+        self.direct_blocks = int((block_size - INODE_METADATA) / ADDR_SIZE) - 2     # Last two slots: indirects
+        self.indirect = INODE_METADATA + (ADDR_SIZE * self.direct_blocks)   # Single (then double) indirect slot
+        self.max_dblocks = self.direct_blocks + self.ptrs_per_block + (self.ptrs_per_block * self.ptrs_per_block)
+        self.max_filesize = min(self.max_dblocks * block_size, (1 << (8*INODE_SIZE_FILESIZE)) - 1)
+        self.entries_per_block = int((block_size - ADDR_SIZE) / INODE_ENTRY_SIZE)  # Inode table slots per table
+                                                                                #   block, before its next pointer
+        self.inline_max = block_size - INODE_METADATA                # Largest file kept inline in its inode
+
+        # Locks around the structures every file shares (each inode and open file has its own, see RWLock)
+        self.alloc_lock = CountingLock(reentrant=True)  # Bitmap, its summary/cursor and free_blocks
+        self.table_lock = CountingLock(reentrant=True)  # Inode table blocks, slots and free_slots
+
+# Journal of a mounted FS: metadata blocks are logged (see meta_writes) into the running transaction instead of
+#   being written in place. The committer thread commits it window seconds after its first block: the block
+#   images go to the journal region with a checksummed commit block behind them, one fsync makes all of it
+#   durable, and only then are the images written in place. Mounting replays whatever committed transactions
+#   the journal still holds, so a crash never leaves half an operation's metadata on disk.
+# Operations run inside a handle (journal_begin/journal_end, see fs_op) and a transaction is only committed once
+#   the handles logging into it have ended. Blocks freed in a transaction are free in the bitmap it logs, but
+#   can only be allocated again once it has committed.
+# Journal region: header block (tid of the first transaction to replay), then transactions back to back:
+#   descriptor blocks each followed by the images they list, revoke blocks, commit block. When the next one
+#   doesn't fit, everything is written in place already: one fsync and the journal starts over.
+class Journal:
+    def __init__(self, fs, window, sync):
+        self.fs = fs
+        self.start = fs.journal_start       # Header block, transactions follow it
+        self.nBlocks = fs.journal_blocks
+        self.window = window                # Seconds a transaction collects operations before it's committed
+        self.sync = sync                    # Operations only return once their transaction committed
+        self.lock = threading.Lock()        # Everything below (the committer waits on cond)
+        self.cond = threading.Condition(self.lock)
+        self.tid = 1                        # Running transaction's id (set by journal_replay)
+        self.committed = 0                  # Last transaction that is durable
+        self.written = 0                    # ^^^ whose commit has finished (transactions commit in tid order)
+        self.head = 1                       # Next free journal block (relative to start)
+        self.running = {}                   # Running transaction: bNum -> held block image (see holdBlocks)
+        self.revoked = set()                # ^^^ logged blocks it freed: their earlier images are void
+        self.freeing = []                   # ^^^ blocks it freed, reusable once it commits
+        self.first = None                   # ^^^ when its first block was logged
+        self.committing = {}                # tid -> blocks freed by a transaction being committed
+        self.to_free = []                   # Blocks freed by committed transactions, see journal_apply
+        self.unapplied = 0                  # ^^^ not free yet (including ones journal_apply is at)
+        self.logged = {}                    # bNum -> tid of its newest image in the journal
+        self.active = 0                     # Handles (running operations)
+        self.draining = False               # A commit waits for the handles to end, new ones wait for it
+        self.stopping = False
+        self.local = threading.local()      # Per thread: handle depth, tid its operation has to wait for
+        self.thread = None                  # Committer
+        self.commits = 0
+        self.blocks = 0                     # Block images committed
+        self.ops = 0                        # Handles ended
 
 
 # File Entry object
 class Filent:
-    def __init__(self, filename):
-        self.filename = filename
+    def __init__(self, filename, parent):
+        self.filename = filename            # Name in its directory
+        self.parent = parent                # Inode block of the directory holding it
         self.offset = 0
         self.bNums = []                     # Block Numbers
+        self.wbuf = {}                      # Write buffer: block index -> block image with unflushed writes
+        self.ra_buf = bytearray()           # Read-ahead: consecutive file blocks prefetched in one read
+        self.ra_start = 0                   # ^^^ File block index of the first block in ra_buf
+        self.ra_window = READAHEAD_MIN_BLOCKS   # Blocks the next prefetch reads
+        self.ra_last = -1                   # File block index the last read touched
+        self.lock = CountingLock()          # Offset and read-ahead state, shared by readers of the file
 
 # File stat entry
 class Stat:
@@ -87,636 +187,2245 @@ class Stat:
             "Modification Time: \t{}\n\n".format(convert_time(self.mtime))
             )
 
-def tfs_mkfs(filename, nBytes):
-    fs_disk = openDisk(filename, nBytes)
+# Inode header: perms, type, flags, size, nBlocks, ctime, atime, mtime (see INODE_* indexes in constants.py)
+INODE_HEADER = struct.Struct('>BBHIIIII')
+# Superblock header: magic number, log2(block size), journal blocks, inode table block, bitmap blocks,
+#   data region start, total blocks, root directory inode block
+SUPERBLOCK_HEADER = struct.Struct('>BBHIIIII')
+# Journal block header: JOURNAL_MAGIC, block type (JBLOCK_*), tid, count (block numbers listed after it, or
+#   for the commit block the transaction's blocks before it, followed by their crc32)
+JOURNAL_BLOCK = struct.Struct('>IIII')
+# Bits covered by one bit of the next bitmap summary level (one scan word)
+SUMMARY_FANOUT = 8*BITMAP_SCAN_BYTES
+# array typecode holding 4-byte block numbers
+BNUM_TYPECODE = 'I' if array('I').itemsize == ADDR_SIZE else 'L'
+
+def bnums_unpack(raw):
+    # Decodes big-endian 4-byte block numbers into an array
+    bNums = array(BNUM_TYPECODE)
+    bNums.frombytes(bytes(raw))
+    if(sys.byteorder == 'little'):
+        bNums.byteswap()
+    return bNums
+
+def bnums_pack(bNums):
+    # Encodes block numbers as big-endian 4-byte values
+    packed = array(BNUM_TYPECODE, bNums)
+    if(sys.byteorder == 'little'):
+        packed.byteswap()
+    return packed.tobytes()
+
+def ptr_blocks_needed(fs, nBlocks):
+    # Number of indirect blocks (single, double, and the double's children) a file of nBlocks data blocks needs
+    extra = nBlocks - fs.direct_blocks
+    if(extra <= 0):
+        return 0
+    if(extra <= fs.ptrs_per_block):
+        return 1
+    return 2 + int(ceil((extra - fs.ptrs_per_block) / float(fs.ptrs_per_block)))
+
+def valid_block_size(block_size):
+    # Block sizes are powers of 2 between MIN_BLOCKSIZE and MAX_BLOCKSIZE
+    return ((MIN_BLOCKSIZE <= block_size <= MAX_BLOCKSIZE) and ((block_size & (block_size - 1)) == 0))
+
+# Readers/writer lock: any number of readers or one writer. A waiting writer holds back new readers (except
+#   threads already reading), and the writer may take the lock again, for reading or writing. Readers can't
+#   upgrade to writing.
+class RWLock:
+    def __init__(self):
+        self.mutex = threading.Lock()       # Guards the fields below
+        self.cond = threading.Condition(self.mutex)
+        self.readers = {}                   # Thread ident -> read holds
+        self.writer = None                  # Thread ident of the writer
+        self.depth = 0                      # ^^^ Number of its holds (nested ones included)
+        self.waiting = 0                    # Writers waiting for the lock
+        self.acquires = 0
+        self.contended = 0                  # Acquires that had to wait
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self.mutex:
+            if(self.writer == me):
+                self.depth += 1
+                return
+            waited = False
+            if(me not in self.readers):
+                while((self.writer is not None) or (self.waiting > 0)):
+                    waited = True
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+            self.acquires += 1
+            self.contended += waited
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self.mutex:
+            if(self.writer == me):
+                self.release_write_locked()
+                return
+            count = self.readers[me] - 1
+            if(count > 0):
+                self.readers[me] = count
+                return
+            del self.readers[me]
+            if((len(self.readers) == 0) and (self.waiting > 0)):     # Only writers wait for readers
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self.mutex:
+            if(self.writer == me):
+                self.depth += 1
+                return
+            waited = False
+            self.waiting += 1
+            while((self.writer is not None) or (len(self.readers) > 0)):
+                waited = True
+                self.cond.wait()
+            self.waiting -= 1
+            self.writer = me
+            self.depth = 1
+            self.acquires += 1
+            self.contended += waited
+
+    def release_write(self):
+        with self.mutex:
+            self.release_write_locked()
+
+    def release_write_locked(self):
+        self.depth -= 1
+        if(self.depth == 0):
+            self.writer = None
+            self.cond.notify_all()
+
+    def read(self):
+        # with lock.read(): ...
+        return LockHold(self.acquire_read, self.release_read)
+
+    def write(self):
+        # with lock.write(): ...
+        return LockHold(self.acquire_write, self.release_write)
+
+# Context manager holding an RWLock one way (a plain class, cheaper than a generator for per-byte calls)
+class LockHold:
+    __slots__ = ('acquire', 'release')
+
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+# Decoded inode, cached per mount in FS.inodes
+class Inode:
+    __slots__ = ('bNum', 'perms', 'type', 'flags', 'size', 'ctime', 'atime', 'mtime', 'blocks', 'ptrs', 'data',
+        'dirty', 'lock')
+
+    def __init__(self, bNum, itype=MODE_DATA):
+        now = int(time.time())
+        self.bNum = bNum                    # Block the inode lives in
+        self.perms = PERMS_RW
+        self.type = itype
+        self.flags = 0
+        self.size = 0
+        self.ctime = now
+        self.atime = now
+        self.mtime = now
+        self.blocks = array(BNUM_TYPECODE)  # All data block numbers in file order (direct + indirect, resolved)
+        self.ptrs = array(BNUM_TYPECODE)    # Indirect blocks: [single, double, double's children...]
+        self.data = None                    # Contents of an inline file (bytearray), None if it uses data blocks
+        self.dirty = False                  # Changed in memory but not yet written back
+        self.lock = RWLock()                # Shared by reads of the file/directory, exclusive for changes
+
+    def unpack(self, fs, block):
+        # Fills this inode in from an inode block read off fs's disk
+        # Only the direct blocks are resolved here, returns the total number of data blocks (see inode_load)
+        (self.perms, self.type, self.flags, self.size, nBlocks,
+            self.ctime, self.atime, self.mtime) = INODE_HEADER.unpack_from(block, 0)
+        if(self.flags & INODE_FLAG_INLINE):     # Data instead of block numbers after the metadata
+            self.data = bytearray(block[INODE_METADATA:INODE_METADATA+min(self.size, fs.inline_max)])
+            self.blocks = array(BNUM_TYPECODE)
+            self.ptrs = array(BNUM_TYPECODE)
+            return 0
+        self.data = None
+        nBlocks = min(nBlocks, fs.max_dblocks)
+        nDirect = min(nBlocks, fs.direct_blocks)
+        self.blocks = bnums_unpack(block[INODE_METADATA:INODE_METADATA+(nDirect*ADDR_SIZE)])
+        self.ptrs = array(BNUM_TYPECODE)
+        nPtrs = ptr_blocks_needed(fs, nBlocks)
+        if(nPtrs > 0):
+            self.ptrs.extend(bnums_unpack(block[fs.indirect:fs.indirect+(min(nPtrs, 2)*ADDR_SIZE)]))
+        return nBlocks
+
+    def pack(self, fs):
+        # Returns this inode encoded as one of fs's inode blocks
+        block = bytearray(fs.block_size)
+        if(self.data is not None):
+            self.flags |= INODE_FLAG_INLINE
+        else:
+            self.flags &= ~INODE_FLAG_INLINE
+        INODE_HEADER.pack_into(block, 0, self.perms, self.type, self.flags, self.size, len(self.blocks),
+            self.ctime, self.atime, self.mtime)
+        if(self.data is not None):
+            block[INODE_METADATA:INODE_METADATA+len(self.data)] = self.data
+            return block
+        raw = bnums_pack(self.blocks[:fs.direct_blocks])
+        block[INODE_METADATA:INODE_METADATA+len(raw)] = raw
+        raw = bnums_pack(self.ptrs[:2])
+        block[fs.indirect:fs.indirect+len(raw)] = raw
+        return block
+
+def tfs_mkfs(filename, nBytes, preallocate=False, block_size=BLOCKSIZE, journal_blocks=None):
+    # The disk file starts out sparse; preallocate=True reserves all of its space up front
+    # block_size (a power of 2, MIN_BLOCKSIZE to MAX_BLOCKSIZE) is recorded in the superblock and used from then on
+    # journal_blocks sizes the journal region (0 = none, None = picked from the disk size, see FS)
+    if(not valid_block_size(block_size)):
+        return ERR_INVALID_BLOCKSIZE
+    fs_disk = openDisk(filename, nBytes, cacheMode=CACHE_WRITE_BACK, preallocate=preallocate, blockSize=block_size,
+        flusher=True)
     if(fs_disk >= 0):                       # FS creation was successful
-        new_fs = FS(nBytes, fs_disk)        # Create new FS
-        extra_blocks = create_superblock(new_fs.disk, new_fs.addr_size, new_fs.nBlocks, new_fs.free_blocks)
-        new_fs.extra_blocks = extra_blocks
+        new_fs = FS(nBytes, fs_disk, block_size, journal_blocks)    # Create new FS
+        if((new_fs.data_start + 2 >= new_fs.nBlocks) or (new_fs.nBlocks >= (1 << (8*ADDR_SIZE))) or
+                (new_fs.journal_blocks > 0xFFFF) or (0 < new_fs.journal_blocks < JOURNAL_MIN_BLOCKS)):
+            closeDisk(fs_disk)              # No room for any data, or more blocks than a block number can address,
+            return ERR_DSKSIZE              #   or a journal too big for the superblock/too small to be of use
+        create_superblock(new_fs)
+        bitmap_load(new_fs)
+        index_load(new_fs)
+
+        # Empty root directory: its inode and first bucket are the first two data region blocks
+        root = Inode(new_fs.root, MODE_DIR)
+        root.blocks.append(new_fs.root + 1)
+        dir_init(new_fs, root)
+        flushDisk(fs_disk)                  # The new image is complete on disk, not just in the cache
         filesystems[filename] = new_fs
         return SUCCESS
     else:                                   # FS creation failed
         return ERR_FAILED_CREAT
 
-def tfs_mount(filename):
-    global mounted
-    global curr_FS
-    if(mounted == True):
-        return ERR_MOUNTED_FS
-    
-    # Check superblock for magic number
-    new_FS = filesystems[filename]
-    superblock = bytearray(BLOCKSIZE)
-    readBlock(new_FS.disk, 0, superblock)
-    if(superblock[0] != MAGIC_NUMBER):
-        return ERR_INVALID_FS
-
-    curr_FS = new_FS
-    mounted = True 
-    return SUCCESS
-
-def tfs_unmount():
-    global curr_FS
-    global mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
-    
-    curr_FS = None
-    mounted = False
-    return SUCCESS
+def fs_op(method):
+    # Handle methods only run while it is mounted, sharing the handle's lock with each other (unmount takes it
+    #   exclusively). What they touch is locked per inode/open file, see open_file.
+    # With a journal each one is a journal handle, and waits for its transaction to commit if it has to (see
+    #   journal_end) once everything is unlocked
+    @functools.wraps(method)
+    def op(self, *args, **kwargs):
+        with self.lock.read():
+            if(not self.mounted):
+                return ERR_MOUNTED_NONE
+            journal = self.fs.journal
+            if(journal is None):
+                return method(self, *args, **kwargs)
+            journal_begin(journal)
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                tid = journal_end(journal)
+        if(tid is not None):
+            journal_wait(journal, tid)
+        return result
+    return op
+
+# with open_file(fs, FD, write) as held: locks open file FD's inode (exclusively if write, shared otherwise) and
+#   gives (Filent, Inode), or None if FD isn't open (anymore: it is checked again once the lock is held, in case
+#   it was closed or deleted)
+class open_file:
+    __slots__ = ('fs', 'FD', 'write', 'lock')
+
+    def __init__(self, fs, FD, write):
+        self.fs = fs
+        self.FD = FD
+        self.write = write
+        self.lock = None
+
+    def __enter__(self):
+        fs = self.fs
+        f = fs.files.get(self.FD)
+        bNum = inode_lookup(fs, self.FD)
+        if((f is None) or (bNum < 0)):
+            return None
+        inode = inode_load(fs, bNum)
+        self.lock = inode.lock
+        if(self.write):
+            self.lock.acquire_write()
+        else:
+            self.lock.acquire_read()
+        return ((f, inode) if fs.files.get(self.FD) is f else None)
+
+    def __exit__(self, *exc):
+        if(self.lock is None):
+            return
+        if(self.write):
+            self.lock.release_write()
+        else:
+            self.lock.release_read()
+
+def file_open(fs, dinode, name, FD):
+    # Adds name (slot FD) in directory dinode to the open files, unless it's a directory. Returns FD or an error
+    #   code. The caller holds dinode's lock, so the entry can't be deleted in between.
+    if(inode_load(fs, inode_lookup(fs, FD)).type == MODE_DIR):
+        return ERR_IS_DIR
+    fs.files.setdefault(FD, Filent(name, dinode.bNum))
+    return FD
+
+def inode_live(fs, inode):
+    # False once the inode has been destroyed (after someone else looked it up)
+    return fs.inodes.get(inode.bNum) is inode
+
+# Handle on one mounted image: its FS (open-file table, inode cache, bitmap, disk and the disk's block cache) is
+#   only used through the handle while it is mounted, so any number of images can be mounted and used side by
+#   side, from different threads. Every method matches the tfs_* function of the same name.
+# Threads can share a handle: operations on different files run concurrently, as do reads of the same file.
+#   Changes to a file (or directory) lock out everything else on it, and a short allocator lock covers the
+#   free block bitmap. lock_stats shows how often each lock had to be waited for.
+class TinyFS:
+    def __init__(self, fs=None):
+        self.fs = fs
+        self.mounted = fs is not None
+        self.lock = RWLock()                # Shared by operations, exclusive for unmount
+
+    @staticmethod
+    def mount(filename, atime_policy=ATIME_STRICT, relatime_age=RELATIME_MAX_AGE,
+            journal_window=JOURNAL_COMMIT_WINDOW, journal_sync=False):
+        # atime_policy decides how reads/writes update inode timestamps:
+        #   ATIME_STRICT:   atime (and mtime) rewritten on the inode on every access
+        #   ATIME_RELATIME: atime only updated if older than mtime or more than relatime_age seconds old
+        #   ATIME_NOATIME:  atime never updated by reads
+        # With the last two, timestamps are kept on the open file and written out at close/unmount
+        # Images with a journal replay it first. Metadata changes are then committed in groups, journal_window
+        #   seconds' worth per fsync; with journal_sync each operation only returns once its changes are
+        #   committed (otherwise only fsync waits for that).
+        # Returns a new mounted handle for the image, or an error code
+        with filesystems_lock:
+            # Images made by an earlier run are opened here, at the block size their superblock records
+            new_FS = filesystems.get(filename)
+            if(new_FS is None):
+                new_FS = fs_open(filename)
+                if(new_FS is None):
+                    return ERR_INVALID_FS
+                filesystems[filename] = new_FS
+            if(new_FS.mounted):             # An image only has one handle at a time
+                return ERR_MOUNTED_FS
+
+            # Check superblock for magic number, block size and layout
+            superblock = bytearray(new_FS.block_size)
+            readBlock(new_FS.disk, 0, superblock)
+            magic, log_size, _, table_start, bitmap_blocks, data_start, _, root = \
+                SUPERBLOCK_HEADER.unpack_from(superblock)
+            if((magic != MAGIC_NUMBER) or ((1 << log_size) != new_FS.block_size)):
+                return ERR_INVALID_FS
+            if((table_start, bitmap_blocks, data_start) != (new_FS.table_start, new_FS.bitmap_blocks,
+                    new_FS.data_start)):
+                return ERR_INVALID_FS
+            new_FS.root = root
+            if(new_FS.journal_blocks > 0):
+                journal_open(new_FS, journal_window, journal_sync)
+            bitmap_load(new_FS)
+            index_load(new_FS)
+            if(new_FS.journal is not None):
+                journal_start(new_FS.journal)
+            new_FS.atime_policy = atime_policy
+            new_FS.relatime_age = relatime_age
+            new_FS.mounted = True
+        return TinyFS(new_FS)
+
+    # Writes back everything still held in memory and detaches the handle from its image, which can then be
+    #   mounted again. Files left open stay open in the image's FS for the next mount.
+    def unmount(self):
+        with self.lock.write():             # Waits for running operations
+            if(not self.mounted):
+                return ERR_MOUNTED_NONE
+            fs = self.fs
+            for FD in fs.files:             # Buffered writes of files still open
+                file_flush(fs, FD)
+            inode_sync(fs)                  # Timestamps kept in memory by the atime policy
+            fs.inodes = {}                  # Inode cache only lives as long as the mount
+            bitmap_sync(fs)
+            if(fs.journal is not None):
+                journal_close(fs.journal)
+            flushDisk(fs.disk)              # Dirty blocks still waiting for the flusher
+            fs.mounted = False
+            self.mounted = False
+        return SUCCESS
 
-def tfs_open(name):
-    global curr_FS
-    # Make sure FS is actually mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
-
-    # Create new inode, and inode-name pair in root dir
-    # Find free inode block
-    for inode_bNum in range(INODE_TABLE_SIZE):
-        inode_entry_block = bytearray(BLOCKSIZE)
-        readBlock(curr_FS.disk, 1+BITMAP_BLOCKS+inode_bNum, inode_entry_block)
-        inode_ind = find_free_inode(inode_entry_block)
-        if(inode_ind >= 0):
-            # Found free inode, now create inode
-            # Find free block on disk to put inode on
-            inode_blk_ind = find_freeblock(curr_FS.disk, curr_FS.extra_blocks)
-            new_inode = create_inode(MODE_DATA, 0, [])
-            # Set creation time to be now
-            inode_set_data(new_inode, INODE_CTIME, INODE_SIZE_TIME, int(time.time()))
-            writeBlock(curr_FS.disk, inode_blk_ind, new_inode)
-            remove_freeblock(curr_FS.disk, inode_blk_ind, curr_FS.extra_blocks)
-            curr_FS.free_blocks -= 1
-
-            inode_entry = bytearray(INODE_ENTRY_SIZE)
-            # Start with name
-            name_bytes = bytearray(name, 'ascii')
-            for i in range(len(name)):
-                inode_entry[i] = name_bytes[i]
-            # Now add index (block number on disk)
-            for i in range(ADDR_SIZE):
-                inode_entry[NAME_SIZE+ADDR_SIZE-(1+i)] = (inode_blk_ind & (0xFF << (8*i))) >> (8*i)
-    
-            # inode has been created and written on disk, update inode table
-            for i in range(INODE_ENTRY_SIZE):
-                inode_entry_block[(inode_ind*INODE_ENTRY_SIZE)+i] = inode_entry[i]
-            writeBlock(curr_FS.disk, 1+BITMAP_BLOCKS+inode_bNum, inode_entry_block)
-            FD = ((int(BLOCKSIZE / INODE_ENTRY_SIZE)) * inode_bNum) + inode_ind
+    # Returns how often each lock had to be waited for: the handle's, the allocator's, the inode table's, the
+    #   disk cache's, and per inode block / open FD the ones that ever were
+    @fs_op
+    def lock_stats(self):
+        fs = self.fs
+        return {
+            "handle": self.lock.contended,
+            "alloc": fs.alloc_lock.contended,
+            "table": fs.table_lock.contended,
+            "disk": disks[fs.disk].lock.contended,
+            "inodes": {bNum: inode.lock.contended for bNum, inode in list(fs.inodes.items())
+                if(inode.lock.contended > 0)},
+            "files": {FD: f.lock.contended for FD, f in list(fs.files.items()) if(f.lock.contended > 0)},
+        }
+
+    # Returns the journal's counters: transactions committed, block images they held and operations they
+    #   covered (None if the image has no journal)
+    @fs_op
+    def journal_stats(self):
+        journal = self.fs.journal
+        if(journal is None):
+            return None
+        return {
+            "commits": journal.commits,
+            "blocks": journal.blocks,
+            "ops": journal.ops,
+        }
+
+    # Opens the file at path (a name in the root directory, or '/'-separated names through subdirectories),
+    #   creating it if it doesn't exist yet. Returns its FD or an error code.
+    @fs_op
+    def open(self, name):
+        fs = self.fs
+        resolved = path_resolve(fs, name)
+        if(not isinstance(resolved, tuple)):
+            return resolved
+        dinode, leaf = resolved
+
+        # File already exists: just (re)open it instead of creating a second entry with the same name
+        with dinode.lock.read():
+            FD = dir_lookup(fs, dinode, leaf)
+            if(FD >= 0):
+                return file_open(fs, dinode, leaf, FD)
+        with dinode.lock.write():
+            if(not inode_live(fs, dinode)):
+                return ERR_FILE_NOT_FOUND
+            FD = dir_lookup(fs, dinode, leaf)   # Someone else may have created it in the meantime
+            if(FD >= 0):
+                return file_open(fs, dinode, leaf, FD)
+
+            # Create new inode, and its inode table entry and directory entry
+            FD = inode_create(fs, dinode, leaf, MODE_DATA)
+            if(FD < 0):
+                return FD
 
             # Create new file entry and add to FS's list of files
-            new_filent = Filent(name)
-            curr_FS.files[FD] = new_filent
-
-            return FD
-    return ERR_NO_FREEBLOCKS
-
-def inode_parse_entry(inode_entry):
-    # Parses inode entry and returns tuple of (name, index)
-    name_bytes = bytearray(NAME_SIZE)
-    for i in range(NAME_SIZE):
-        name_bytes[i] = inode_entry[i]
-    name = bytes(name_bytes).decode()
-    index = 0
-    for i in range(ADDR_SIZE):
-        index |= (inode_entry[NAME_SIZE+i] << (8*(ADDR_SIZE-(i+1))))
-    return (name, index)
-
-def find_free_inode(inode_block):
-    # Searches inode_block for free inode pair opening and returns index if successful
-    # Index = index in inode_block list not index on disk array of bytes
-    for i in range(int(BLOCKSIZE / INODE_ENTRY_SIZE)):
-        inode_entry = inode_block[(i*INODE_ENTRY_SIZE):((i*INODE_ENTRY_SIZE)+INODE_ENTRY_SIZE)]
-        found = True
-        for j in range(INODE_ENTRY_SIZE):
-            if((inode_entry[j] & 0xFF) != 0):
-                found = False
-        if(found):
-            return i
-    return -1
+            new_filent = Filent(leaf, dinode.bNum)
+            fs.files[FD] = new_filent
+        return FD
+
+    # Creates an empty directory at path. Returns SUCCESS or an error code.
+    @fs_op
+    def mkdir(self, path):
+        fs = self.fs
+        resolved = path_resolve(fs, path)
+        if(not isinstance(resolved, tuple)):
+            return resolved
+        dinode, leaf = resolved
+        with dinode.lock.write():
+            if(not inode_live(fs, dinode)):
+                return ERR_FILE_NOT_FOUND
+            if(dir_lookup(fs, dinode, leaf) >= 0):
+                return ERR_INVALID_NAME
+            FD = inode_create(fs, dinode, leaf, MODE_DIR)
+            if(FD < 0):
+                return FD
+        return SUCCESS
 
-def inode_get_entry(FD):
-    # Given FD, return inode entry
-    global curr_FS
-    inode_bNum = int(FD / (BLOCKSIZE / INODE_ENTRY_SIZE))
-    inode_offset = FD - (inode_bNum * INODE_ENTRY_SIZE)
-    inode_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, 1+BITMAP_BLOCKS+inode_bNum, inode_block)
-    return inode_block[(inode_offset*INODE_ENTRY_SIZE):((inode_offset*INODE_ENTRY_SIZE)+INODE_ENTRY_SIZE)]
+    # Removes the empty directory at path. Returns SUCCESS or an error code.
+    @fs_op
+    def rmdir(self, path):
+        fs = self.fs
+        resolved = path_resolve(fs, path)
+        if(not isinstance(resolved, tuple)):
+            return resolved
+        dinode, leaf = resolved
+        with dinode.lock.write():
+            FD = dir_lookup(fs, dinode, leaf)
+            if(FD < 0):
+                return ERR_FILE_NOT_FOUND
+            inode = inode_load(fs, inode_lookup(fs, FD))
+            if(inode.type != MODE_DIR):
+                return ERR_NOT_DIR
+            with inode.lock.write():
+                if(len(dir_list(fs, inode)) > 0):
+                    return ERR_DIR_NOT_EMPTY
+                inode_destroy(fs, FD, inode)
+                dir_remove(fs, dinode, leaf)
+        return SUCCESS
 
-def inode_remove_entry(FD):
-    global curr_FS
-    inode_bNum = int(FD / (BLOCKSIZE / INODE_ENTRY_SIZE))
-    inode_offset = FD - (inode_bNum * INODE_ENTRY_SIZE)
-    inode_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, 1+BITMAP_BLOCKS+inode_bNum, inode_block)
-    for i in range(INODE_ENTRY_SIZE):
-        inode_block[(inode_offset*INODE_ENTRY_SIZE)+i] = 0x00
-    writeBlock(curr_FS.disk, 1+BITMAP_BLOCKS+inode_bNum, inode_block) 
-
-def inode_update_blocks(inode_block, blocks):
-    # Updates inode with new data blocks
-    blk_index = INODE_METADATA
-    for block in blocks:
-        for i in range(ADDR_SIZE):
-            inode_block[blk_index+ADDR_SIZE-(i+1)] = (block & (0xFF << (8*i))) >> (8*i)
-        blk_index += ADDR_SIZE
-
-def inode_update_size(inode_block, size):
-    # Updates the 'size' field in the inode block
-    inode_block[2] = (size & (0xFF << 8)) >> 8
-    inode_block[3] = size & (0xFF)
-
-def inode_get_blocks(inode_block):
-    # Gets blocks from inode block
-    blocks = []
-    blk_index = INODE_METADATA
-    more_blocks = True
-    next_blk = bytearray()
-    while(more_blocks and (blk_index < BLOCKSIZE)):
-        next_blk = inode_block[blk_index:blk_index+ADDR_SIZE]
-        more_blocks = False
-        for i in range(ADDR_SIZE):
-            if(next_blk[i] != 0x00):
-                more_blocks = True
-        if(more_blocks):
-            blocks.append(int.from_bytes(next_blk, 'big'))
-        blk_index += ADDR_SIZE
-    return blocks
-        
-def inode_get_data(inode_block, start, size):
-    # Gets data from inode, starting at a given index
-    # Translates multiple bytes of data into one number
-    t = 0
-    for i in range(size):
-        t |= (inode_block[start+i] << (8*(size-(1+i))))
-    return t
-
-def inode_set_data(inode_block, start, size, data):
-    # Sets data field of an inode
-    # Translates 'data' into multiple bytes as determined by 'size'
-    for i in range(size):
-        inode_block[start+i] = (data & (0xFF << (8*(size-(1+i))))) >> (8*(size-(1+i)))
+    # Lists the names in the directory at path ('/' or '' for the root), in hash order. Returns a list of names
+    #   or an error code.
+    @fs_op
+    def readdir(self, path="/"):
+        fs = self.fs
+        dinode = dir_resolve(fs, path_split(path))
+        if(not isinstance(dinode, Inode)):
+            return dinode
+        with dinode.lock.read():
+            return [name for name, slot in dir_list(fs, dinode)]
+
+    @fs_op
+    def stat(self, FD):
+        # All metadata stored in inode
+        fs = self.fs
+        entry = fs.slots.get(FD)
+        if(entry is None):
+            return ERR_INVALID_FD
+        inode = inode_load(fs, entry[1])
+        with inode.lock.read():
+            return Stat(entry[0], FD, inode.perms, inode.type, inode.size, len(inode.blocks),
+                inode.ctime, inode.atime, inode.mtime)
+
+    @fs_op
+    def get_FD(self, name):
+        # Gets FD for a file from its path (directory lookups, file doesn't have to be open)
+        # Also called from set_perms, inside its operation (the handle lock and journal handle nest)
+        fs = self.fs
+        resolved = path_resolve(fs, name)
+        if(not isinstance(resolved, tuple)):
+            return ERR_NO_FD
+        with resolved[0].lock.read():
+            FD = dir_lookup(fs, resolved[0], resolved[1])
+        if(FD < 0):
+            return ERR_NO_FD
+        return FD
+
+    @fs_op
+    def makeRO(self, name):
+        return self.set_perms(name, PERMS_RO)
+
+    @fs_op
+    def makeRW(self, name):
+        return self.set_perms(name, PERMS_RW)
+
+    def set_perms(self, name, perms):
+        fs = self.fs
+        # Make sure file exists and grab its file descriptor
+        bNum = inode_lookup(fs, self.get_FD(name))
+        if(bNum < 0):
+            return ERR_FILE_NOT_FOUND
+
+        # Get and change inode's permissions
+        inode = inode_load(fs, bNum)
+        with inode.lock.write():
+            inode.perms = perms
+
+            # Update inode's modify/access times to reflect change
+            atime_mtime = int(time.time())
+            inode.atime = atime_mtime
+            inode.mtime = atime_mtime
+
+            # Write updated inode back to disk
+            inode_store(fs, inode)
+        return SUCCESS
 
-def tfs_stat(FD):
-    # All metadata stored in inode
-    inode_block = inode_get_block(FD)
-    inode_entry = inode_parse_entry(inode_get_entry(FD))
-    itype = inode_get_data(inode_block, INODE_TYPE, INODE_SIZE_TYPE)
-    perms = inode_get_data(inode_block, INODE_PERMS, INODE_SIZE_PERMS)
-    isize = inode_get_data(inode_block, INODE_FILESIZE, INODE_SIZE_FILESIZE)
-    nBlocks = inode_get_data(inode_block, INODE_NBLOCKS, INODE_SIZE_NBLOCKS)
-    ctime = inode_get_data(inode_block, INODE_CTIME, INODE_SIZE_TIME)
-    atime = inode_get_data(inode_block, INODE_ATIME, INODE_SIZE_TIME)
-    mtime = inode_get_data(inode_block, INODE_MTIME, INODE_SIZE_TIME)
-    return Stat(inode_entry[INODE_ENTRY_NAME], FD, perms, itype, isize, nBlocks, ctime, atime, mtime)
+    @fs_op
+    def writeByte(self, FD, offset, data):
+        # NOTE: Assumes data is given as a bytes object
+        fs = self.fs
+        with open_file(fs, FD, True) as held:
+            if(held is None):               # Make sure file is open
+                return ERR_INVALID_FD
+            f, inode = held
+
+            # Check to make sure file is NOT read-only (RO)
+            if(inode.perms == PERMS_RO):
+                return ERR_INVALID_PERMS
+
+            # Make sure offset isn't outside file's boundaries
+            if((offset < 0) or (offset >= inode.size)):
+                return ERR_INVALID_OFFSET
+
+            # Offset is valid: the byte goes into the file's write buffer, the block (and the inode's new
+            #   modification time) reach the disk at the next flush
+            file_buffer(fs, FD, inode, offset, bytes((data,)))
+        return SUCCESS
 
-def get_FD(name):
-    # Gets FD for a file from its name
-    global curr_FS
-    for FD in curr_FS.files:
-        if(curr_FS.files[FD].filename == name):
-            return FD
-    return ERR_NO_FD
+    # Closes the file and removes dynamic resource table entry
+    @fs_op
+    def close(self, FD):
+        fs = self.fs
+        with open_file(fs, FD, True) as held:
+            if(held is None):               # Make sure file is open for closing
+                return ERR_INVALID_FD
+            f, inode = held
+
+            file_flush(fs, FD)              # Buffered writes
+            inode_sync(fs, inode)           # Persist timestamps kept in memory
+            del fs.files[FD]                # Remove Filent
+        return SUCCESS
 
-def tfs_makeRO(name):
-    global curr_FS
-    # Make sure file exists and grab its file descriptor
-    FD = get_FD(name)
-    if(FD == ERR_NO_FD):
-        return ERR_FILE_NOT_FOUND
+    # Makes everything written to the file so far durable: buffered writes, the inode (whatever the atime policy)
+    #   and the disk's cached blocks are all written and the disk file is flushed
+    @fs_op
+    def fsync(self, FD):
+        fs = self.fs
+        with open_file(fs, FD, True) as held:
+            if(held is None):
+                return ERR_INVALID_FD
+            file_flush(fs, FD)
+            inode_sync(fs, held[1])
+        bitmap_sync(fs)
+        flushDisk(fs.disk)
+        if(fs.journal is not None):         # Metadata is durable once it's committed
+            journal_want(fs.journal)
+        return SUCCESS
 
-    # Get and change inode to make it read-only
-    inode_block = inode_get_block(FD)
-    inode_set_data(inode_block, INODE_PERMS, INODE_SIZE_PERMS, PERMS_RO)
+    @fs_op
+    def write(self, FD, buffer, size):
+        fs = self.fs
+        with open_file(fs, FD, True) as held:
+            if(held is None):               # Make sure file is open
+                return ERR_INVALID_FD
+            f, inode = held
+
+            # Check to make sure file is NOT read-only (RO)
+            if(inode.perms == PERMS_RO):
+                return ERR_INVALID_PERMS
+
+            # Make sure the file can hold size bytes, and there are enough free blocks on top of the ones it
+            #   already has (data blocks plus any indirect blocks they need)
+            # Files that fit in the inode are kept there and need no data blocks at all
+            inline = (size <= fs.inline_max)
+            fBlocks = 0 if inline else int(ceil(size / float(fs.block_size)))
+            if((fBlocks > fs.max_dblocks) or (size > fs.max_filesize)):
+                return ERR_FILE_TOO_LARGE
+            have = len(inode.blocks) + len(inode.ptrs)
+            if(not free_blocks_wait(fs, fBlocks + ptr_blocks_needed(fs, fBlocks) - have)):
+                return ERR_NO_FREEBLOCKS
+
+            # The file's current blocks are reused: surplus ones are freed, missing ones allocated after the last
+            #   one. Then the whole buffer is written from the start, contiguous runs of blocks in one go
+            f.wbuf = {}                     # Nothing of the old contents has to survive, buffered writes included
+            readahead_drop(f)
+            file_shrink(fs, inode, fBlocks)
+            inode.size = 0
+            if(inline):
+                inode.data = bytearray(blockView(buffer)[:size])
+            else:
+                inode.data = None
+                status = file_write(fs, inode, blockView(buffer)[:size], 0)
+                if(status < 0):
+                    return status
+
+            # Update inode with new size/nBlocks/atime/mtime
+            inode.size = size
+            inode.atime = inode.mtime = int(time.time())
+            inode_store(fs, inode)
+        return SUCCESS
 
-    # Update inode's modify/access times to reflect change
-    atime_mtime = int(time.time())
-    inode_set_data(inode_block, INODE_ATIME, INODE_SIZE_TIME, atime_mtime)
-    inode_set_data(inode_block, INODE_MTIME, INODE_SIZE_TIME, atime_mtime)
+    # Writes size bytes of buffer at offset (at most the file's size, so the file can grow but has no holes) without
+    #   touching any other part of the file. With offset=None the file's offset is used and moved past the data.
+    #   Returns the number of bytes written or an error code.
+    @fs_op
+    def pwrite(self, FD, buffer, size, offset=None):
+        fs = self.fs
+        with open_file(fs, FD, True) as held:
+            if(held is None):               # Make sure file is open
+                return ERR_INVALID_FD
+            f, inode = held
+
+            # Check to make sure file is NOT read-only (RO)
+            if(inode.perms == PERMS_RO):
+                return ERR_INVALID_PERMS
+
+            at = f.offset if offset is None else offset
+            if((at < 0) or (at > inode.size)):
+                return ERR_INVALID_OFFSET
+            bs = fs.block_size
+            view = blockView(buffer)[:size]
+            if((0 < len(view) < bs) and (int(at / bs) == int((at + len(view) - 1) / bs)) and
+                    (at + len(view) <= inode.size)):
+                # Small write inside one block of the file: buffer it
+                file_buffer(fs, FD, inode, at, view)
+                if(offset is None):
+                    f.offset = at + len(view)
+                return len(view)
+            file_flush(fs, FD)              # Anything buffered goes out before (and isn't overwritten by) this write
+            readahead_drop(f)
+            oldSize = inode.size
+            oldBlocks = len(inode.blocks)
+            count = file_write(fs, inode, view, at)
+            if(count < 0):
+                return count
+            if(offset is None):
+                f.offset = at + count
+
+            # Size/block list changes (and inline data) are written now, plain overwrites follow the atime policy
+            inode_touch(fs, inode, True)
+            if(inode.dirty and ((inode.size != oldSize) or (len(inode.blocks) != oldBlocks) or
+                    (inode.data is not None))):
+                inode_store(fs, inode)
+        return count
+
+    # Writes size bytes of buffer at the end of the file and moves the file's offset to the new end.
+    #   Returns the number of bytes written or an error code.
+    @fs_op
+    def append(self, FD, buffer, size):
+        fs = self.fs
+        with open_file(fs, FD, True) as held:   # Held across the write, so the end can't move in between
+            if(held is None):
+                return ERR_INVALID_FD
+            f, inode = held
+            count = self.pwrite(FD, buffer, size, inode.size)
+            if(count >= 0):
+                f.offset = inode.size
+        return count
+
+    # deletes a file and marks its blocks as free on disk.
+    @fs_op
+    def delete(self, FD):
+        fs = self.fs
+
+        # Get File Entry for file to be deleted
+        filent = fs.files.get(FD)
+        if(filent is None):
+            return ERR_INVALID_FD
+
+        # Its directory is locked first (always directory before file), then the file itself
+        dinode = inode_load(fs, filent.parent)
+        with dinode.lock.write():
+            with open_file(fs, FD, True) as held:
+                if(held is None):
+                    return ERR_INVALID_FD
+
+                # Find inode and its associated datablocks, to be removed later
+                inode = held[1]
+
+                # Check to make sure file is NOT read-only (RO)
+                if(inode.perms == PERMS_RO):
+                    return ERR_INVALID_PERMS
+
+                # The file is no longer open, then free its blocks and inode table entry (the slot can be
+                #   reused right away) and take it out of its directory
+                del fs.files[FD]
+                inode_destroy(fs, FD, inode)
+                dir_remove(fs, dinode, filent.filename)
+        return SUCCESS
 
-    inode_bNum = inode_parse_entry(inode_get_entry(FD))[INODE_ENTRY_INDEX]
+    @fs_op
+    def readByte(self, FD, buffer):
+        # NOTE: Assumes buffer is passed as a char array of size 1
+        fs = self.fs
+        with open_file(fs, FD, False) as held:
+            if(held is None):               # Make sure file is open
+                return ERR_INVALID_FD
+            f, inode = held
+
+            # Offset and read-ahead are shared by everyone reading the file
+            with f.lock:
+                if((f.offset < 0) or (f.offset >= inode.size)):
+                    return ERR_INVALID_OFFSET
+
+                # Offset is valid, find which data block byte is in (the write buffer's copy is the newest one)
+                idx = int(f.offset / fs.block_size)
+                dbOffset = int(f.offset % fs.block_size)
+
+                if(inode.data is not None):     # Inline file, the data came with the inode
+                    data_block = inode.data
+                else:
+                    data_block = f.wbuf.get(idx)
+                if(data_block is None):
+                    data_block = readahead_block(fs, f, inode, idx)
+
+                # Once you have data block, put byte into buffer & increment offset
+                buffer[0] = data_block[dbOffset]
+                f.offset += 1
+
+            # Update inode with new access time (written now or at close, per atime policy)
+            inode_touch(fs, inode, False)
+
+    # Reads up to len(buffer) bytes at the file's offset straight into buffer (anything writable supporting the
+    #   buffer protocol) and advances the offset. Returns the number of bytes read (0 at EOF) or an error code.
+    # Concurrent reads of the file each get the next range of it, only read-ahead hits are serialized.
+    @fs_op
+    def readinto(self, FD, buffer):
+        fs = self.fs
+        f = fs.files.get(FD)
+        if((f is not None) and (len(f.wbuf) > 0)):
+            with open_file(fs, FD, True) as held:  # Buffered writes are flushed before reading
+                if(held is not None):
+                    file_flush(fs, FD)
+        with open_file(fs, FD, False) as held:
+            if(held is None):
+                return ERR_INVALID_FD
+            f, inode = held
+
+            # Inode and its block list are looked up once for the whole read
+            dbNums = inode.blocks
+            bs = fs.block_size
+            size = inode.size if inode.data is not None else min(inode.size, len(dbNums)*bs)
+
+            # The range read is claimed up front, moving the offset past it
+            view = blockView(buffer)
+            with f.lock:
+                start = f.offset
+                if(start < 0):
+                    return ERR_INVALID_OFFSET
+                count = min(len(view), size - start)
+                if(count <= 0):
+                    return 0
+                f.offset += count
+            if(inode.data is not None):         # Inline file, the data came with the inode
+                view[:count] = inode.data[start:start+count]
+                inode_touch(fs, inode, False)
+                return count
+
+            # Whole blocks are read directly into the caller's buffer (one vectored read for all of them),
+            #   only a partial head/tail block comes out of the read-ahead buffer
+            idx = int(start / bs)
+            lo = start % bs
+            pos = 0
+            if((lo != 0) or (count < bs)):      # Partial head block
+                pos = min(bs - lo, count)
+                with f.lock:
+                    view[:pos] = readahead_block(fs, f, inode, idx)[lo:lo+pos]
+                idx += 1
+            nFull = int((count - pos) / bs)
+            if(nFull > 0):
+                readBlocks(fs.disk, dbNums[idx:idx+nFull], view[pos:pos+(nFull*bs)])
+                pos += nFull*bs
+                idx += nFull
+                with f.lock:
+                    f.ra_last = idx - 1         # Still counts as sequential for the next read
+            if(pos < count):                    # Partial tail block
+                with f.lock:
+                    view[pos:count] = readahead_block(fs, f, inode, idx)[:count-pos]
+
+            # Update inode with new access time, once for the whole call
+            inode_touch(fs, inode, False)
+        return count
+
+    # Reads up to size bytes at the file's offset and returns them as bytes (b'' at EOF), or an error code
+    @fs_op
+    def read(self, FD, size):
+        buffer = bytearray(size)
+        count = self.readinto(FD, buffer)
+        if(count < 0):
+            return count
+        return bytes(memoryview(buffer)[:count])
+
+    # change the file pointer location to offset (absolute). Returns success/error codes.
+    @fs_op
+    def seek(self, FD, offset):
+        fs = self.fs
+        with open_file(fs, FD, True) as held:
+            if(held is None):               # Make sure file is open
+                return ERR_INVALID_FD
+            f, inode = held
+
+            # Make sure you're not trying to seek before the start or past EOF
+            if((offset < 0) or (offset >= inode.size)):
+                return ERR_INVALID_SEEK
+
+            # Moving to another block ends the current run of buffered writes, and anything but staying in the
+            #   block last read or moving to the next one isn't sequential access anymore
+            idx = int(offset / fs.block_size)
+            if(idx != int(f.offset / fs.block_size)):
+                file_flush(fs, FD)
+            if((idx != f.ra_last) and (idx != f.ra_last + 1)):
+                f.ra_window = READAHEAD_MIN_BLOCKS
+            f.offset = offset
+        return SUCCESS
 
-    # Write updated inode back to disk
-    writeBlock(curr_FS.disk, inode_bNum, inode_block)
+def fs_open(filename):
+    # Opens an existing image: the superblock header is read at the smallest block size to find the real one,
+    #   then the disk is reopened at that block size. Returns the FS, or None if it isn't a valid image.
+    probe = openDisk(filename, 0, cacheBlocks=0, blockSize=MIN_BLOCKSIZE)
+    if(probe < 0):
+        return None
+    header = bytearray(MIN_BLOCKSIZE)
+    status = readBlock(probe, 0, header)
+    closeDisk(probe)
+    magic, log_size, journal_blocks = SUPERBLOCK_HEADER.unpack_from(header)[:3]
+    if((status != SUCCESS) or (magic != MAGIC_NUMBER) or (log_size >= 32)):
+        return None
+    block_size = 1 << log_size
+    if(not valid_block_size(block_size)):
+        return None
+    fs_disk = openDisk(filename, 0, cacheMode=CACHE_WRITE_BACK, blockSize=block_size, flusher=True)
+    if(fs_disk < 0):
+        return None
+    return FS(disks[fs_disk].size, fs_disk, block_size, journal_blocks)
+
+# The tfs_* functions work on the default handle, the one image mounted with tfs_mount
+default_handle = TinyFS()
+
+def tfs_mount(filename, atime_policy=ATIME_STRICT, relatime_age=RELATIME_MAX_AGE,
+        journal_window=JOURNAL_COMMIT_WINDOW, journal_sync=False):
+    # Mounts filename as the default handle, see TinyFS.mount
+    global default_handle
+    global curr_FS
+    global mounted
+    if(mounted == True):
+        return ERR_MOUNTED_FS
+    handle = TinyFS.mount(filename, atime_policy, relatime_age, journal_window, journal_sync)
+    if(not isinstance(handle, TinyFS)):
+        return handle
+    default_handle = handle
+    curr_FS = handle.fs
+    mounted = True
     return SUCCESS
 
-def tfs_makeRW(name):
+def tfs_unmount():
     global curr_FS
-    # Make sure file exists and grab its file descriptor
-    FD = get_FD(name)
-    if(FD == ERR_NO_FD):
-        return ERR_FILE_NOT_FOUND
+    global mounted
+    status = default_handle.unmount()
+    if(status == SUCCESS):
+        curr_FS = None
+        mounted = False
+    return status
 
-    # Get and change inode to make it read-only
-    inode_block = inode_get_block(FD)
-    inode_set_data(inode_block, INODE_PERMS, INODE_SIZE_PERMS, PERMS_RW)
+def tfs_open(name):
+    return default_handle.open(name)
 
-    # Update inode's modify/access times to reflect change
-    atime_mtime = int(time.time())
-    inode_set_data(inode_block, INODE_ATIME, INODE_SIZE_TIME, atime_mtime)
-    inode_set_data(inode_block, INODE_MTIME, INODE_SIZE_TIME, atime_mtime)
+def tfs_mkdir(path):
+    return default_handle.mkdir(path)
 
-    inode_bNum = inode_parse_entry(inode_get_entry(FD))[INODE_ENTRY_INDEX]
+def tfs_rmdir(path):
+    return default_handle.rmdir(path)
 
-    # Write updated inode back to disk
-    writeBlock(curr_FS.disk, inode_bNum, inode_block)
-    return SUCCESS
+def tfs_readdir(path="/"):
+    return default_handle.readdir(path)
 
-def tfs_writeByte(FD, offset, data):
-    # NOTE: Assumes data is given as a bytes object
-    global curr_FS
-    # Make sure FS is actually mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
+def tfs_stat(FD):
+    return default_handle.stat(FD)
 
-    if(FD not in curr_FS.files):        # Make sure file is open
-        return ERR_INVALID_FD
-    
-    # Get inode entry to find where inode is, so it can be updated later
-    inode_entry = inode_get_entry(FD)
-    inode_bNum = inode_parse_entry(inode_get_entry(FD))[INODE_ENTRY_INDEX]
-    inode_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, inode_bNum, inode_block)
-
-    # Check to make sure file is NOT read-only (RO)
-    perms = inode_get_data(inode_block, INODE_PERMS, INODE_SIZE_PERMS)
-    if(perms == PERMS_RO):
-        return ERR_INVALID_PERMS
-
-    # Make sure offset isn't outside file's boundaries
-    size = inode_get_data(inode_block, INODE_FILESIZE, INODE_SIZE_FILESIZE)
-    f = curr_FS.files[FD]
-    if(f.offset >= size):
-        return ERR_INVALID_OFFSET
-
-    # Offset is valid, find which data block byte is in
-    dbNums = inode_get_blocks(inode_block)
-    dbNum = dbNums[int(offset / BLOCKSIZE)]
-    dbOffset = int(offset % BLOCKSIZE)
-
-    data_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, dbNum, data_block)
-
-    # Once you have data block, insert data at offset
-    data_block[dbOffset] = data
-
-    # Write updated datablock back onto disk
-    writeBlock(curr_FS.disk, dbNum, data_block)
-
-    # Update inode block with new access/modification time
-    atime_mtime = int(time.time())
-    inode_set_data(inode_block, INODE_ATIME, INODE_SIZE_TIME, atime_mtime)
-    inode_set_data(inode_block, INODE_MTIME, INODE_SIZE_TIME, atime_mtime)
-    writeBlock(curr_FS.disk, inode_bNum, inode_block)
-    return SUCCESS
+def tfs_makeRO(name):
+    return default_handle.makeRO(name)
 
+def tfs_makeRW(name):
+    return default_handle.makeRW(name)
+
+def tfs_writeByte(FD, offset, data):
+    return default_handle.writeByte(FD, offset, data)
 
-# Closes the file and removes dynamic resource table entry
 def tfs_close(FD):
-    global curr_FS
-    # Make sure FS is actually mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
-    if(FD >= len(curr_FS.files)):       # Make sure file is open for closing
-        return ERR_INVALID_FD  
+    return default_handle.close(FD)
 
-    curr_FS.files[FD] = None            # Remove Filent (set to None)     
-    return SUCCESS
+def tfs_fsync(FD):
+    return default_handle.fsync(FD)
 
 def tfs_write(FD, buffer, size):
-    global curr_FS
-    # Make sure FS is actually mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
+    return default_handle.write(FD, buffer, size)
 
-    if(FD not in curr_FS.files):        # Make sure file is open
-        return ERR_INVALID_FD
-    
-    # Get inode entry to find where inode is, so it can be updated later
-    inode_entry = inode_get_entry(FD)
-    inode_bNum = int.from_bytes(bytes(inode_entry[NAME_SIZE:NAME_SIZE+ADDR_SIZE]), 'big')
-    inode_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, inode_bNum, inode_block)
-
-    # Check to make sure file is NOT read-only (RO)
-    perms = inode_get_data(inode_block, INODE_PERMS, INODE_SIZE_PERMS)
-    if(perms == PERMS_RO):
-        return ERR_INVALID_PERMS
-
-    # Make sure there are enough free blocks
-    fBlocks = int(size / BLOCKSIZE)
-    if(fBlocks > curr_FS.free_blocks):
-        return ERR_NO_FREEBLOCKS
+def tfs_pwrite(FD, buffer, size, offset=None):
+    return default_handle.pwrite(FD, buffer, size, offset)
 
-    # Find all the free blocks you can use for file
-    bNums = []
-    for i in range(fBlocks):
-        # Find freeblock and mark as no longer free on bitmap
-        bNum = find_freeblock(curr_FS.disk, curr_FS.extra_blocks)
-        remove_freeblock(curr_FS.disk, bNum, curr_FS.extra_blocks)
-        bNums.append(bNum)
-
-    # Update inode block with data blocks and new size/nBlocks/atime/mtime
-    inode_update_blocks(inode_block, bNums)
-    inode_set_data(inode_block, INODE_FILESIZE, INODE_SIZE_FILESIZE, size)
-    inode_set_data(inode_block, INODE_NBLOCKS, INODE_SIZE_NBLOCKS, len(bNums))
-    atime_mtime = int(time.time())
-    inode_set_data(inode_block, INODE_ATIME, INODE_SIZE_TIME, atime_mtime)
-    inode_set_data(inode_block, INODE_MTIME, INODE_SIZE_TIME, atime_mtime)
-
-    writeBlock(curr_FS.disk, inode_bNum, inode_block)
-
-    # Now write the data blocks
-    for i in range(len(bNums)):
-        data_block = buffer[(i*BLOCKSIZE):(i*BLOCKSIZE)+BLOCKSIZE]
-        writeBlock(curr_FS.disk, bNums[i], data_block)
-    
-    return SUCCESS
-    
-def inode_get_block(FD):
-    # Gets inode block given FD
-    inode_entry = inode_get_entry(FD)
-    inode_bNum = int.from_bytes(bytes(inode_entry[NAME_SIZE:NAME_SIZE+ADDR_SIZE]), 'big')
-    inode_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, inode_bNum, inode_block)
-    return inode_block
-
-# deletes a file and marks its blocks as free on disk.
-def tfs_delete(FD):
-    global curr_FS
-    # Make sure FS is actually mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
+def tfs_append(FD, buffer, size):
+    return default_handle.append(FD, buffer, size)
 
-    # Get File Entry for file to be deleted
-    if(FD not in curr_FS.files):
-        return ERR_INVALID_FD
-    filent = curr_FS.files[FD]
+def tfs_delete(FD):
+    return default_handle.delete(FD)
 
-    # Find inode and its associated datablocks, to be removed later
-    inode_entry = inode_get_entry(FD)
-    inode_bNum = int.from_bytes(bytes(inode_entry[NAME_SIZE:NAME_SIZE+ADDR_SIZE]), 'big')
-    inode_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, inode_bNum, inode_block)
-    
-    # Check to make sure file is NOT read-only (RO)
-    perms = inode_get_data(inode_block, INODE_PERMS, INODE_SIZE_PERMS)
-    if(perms == PERMS_RO):
-        return ERR_INVALID_PERMS
+def tfs_readByte(FD, buffer):
+    return default_handle.readByte(FD, buffer)
 
-    bNums = inode_get_blocks(inode_block)
-    bNums.append(inode_bNum)
+def tfs_readinto(FD, buffer):
+    return default_handle.readinto(FD, buffer)
 
-    # Add inode and data blocks back to freeblock bitmap
-    for bNum in bNums:
-        add_freeblock(curr_FS.disk, bNum, curr_FS.extra_blocks)
-    # Remove inode entry
-    inode_remove_entry(FD)
-    return SUCCESS
+def tfs_read(FD, size):
+    return default_handle.read(FD, size)
 
-def tfs_readByte(FD, buffer):
-    # NOTE: Assumes buffer is passed as a char array of size 1
-    # Make sure FS is actually mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
+def tfs_seek(FD, offset):
+    return default_handle.seek(FD, offset)
 
-    f = curr_FS.files[FD]
-    # Grab inode
-    inode_block = inode_get_block(FD)
+def get_FD(name):
+    return default_handle.get_FD(name)
 
-    # Get size of file from inode
-    size_bytes = inode_block[2:4]
-    size = (size_bytes[0] << 8) | (size_bytes[1])
+# asyncio front end of a TinyFS handle: every operation runs on a bounded pool of worker threads, so block I/O
+#   never blocks the event loop, and awaiting it gives what the tfs_* function of the same name returns (same
+#   arguments, results and error codes). Operations run concurrently as the handle's locks allow, and concurrent
+#   reads of the same block share one disk read (see readShared in libDisk).
+class AsyncTinyFS:
+    def __init__(self, handle, workers=ASYNC_WORKERS, executor=None):
+        self.handle = handle
+        self.executor = executor or ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tinyfs")
+
+    @staticmethod
+    async def mount(filename, atime_policy=ATIME_STRICT, relatime_age=RELATIME_MAX_AGE, workers=ASYNC_WORKERS,
+            journal_window=JOURNAL_COMMIT_WINDOW, journal_sync=False):
+        # Mounts filename (see TinyFS.mount) from a worker thread. Returns an AsyncTinyFS or an error code.
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tinyfs")
+        handle = await asyncio.get_running_loop().run_in_executor(executor, TinyFS.mount, filename, atime_policy,
+            relatime_age, journal_window, journal_sync)
+        if(not isinstance(handle, TinyFS)):
+            executor.shutdown(wait=False)
+            return handle
+        return AsyncTinyFS(handle, executor=executor)
+
+    async def run(self, op, *args):
+        # Runs op(*args) on a worker thread
+        if(not self.handle.mounted):        # Unmounted, the workers are gone
+            return ERR_MOUNTED_NONE
+        return await asyncio.get_running_loop().run_in_executor(self.executor, op, *args)
+
+    async def unmount(self):
+        # Unmounts the handle once the operations already started are done, then stops the workers
+        status = await self.run(self.handle.unmount)
+        self.executor.shutdown(wait=False)
+        return status
+
+    async def open(self, name):
+        return await self.run(self.handle.open, name)
+
+    async def close(self, FD):
+        return await self.run(self.handle.close, FD)
+
+    async def read(self, FD, size):
+        return await self.run(self.handle.read, FD, size)
+
+    async def readinto(self, FD, buffer):
+        return await self.run(self.handle.readinto, FD, buffer)
+
+    async def readByte(self, FD, buffer):
+        return await self.run(self.handle.readByte, FD, buffer)
+
+    async def write(self, FD, buffer, size):
+        return await self.run(self.handle.write, FD, buffer, size)
+
+    async def pwrite(self, FD, buffer, size, offset=None):
+        return await self.run(self.handle.pwrite, FD, buffer, size, offset)
+
+    async def append(self, FD, buffer, size):
+        return await self.run(self.handle.append, FD, buffer, size)
+
+    async def writeByte(self, FD, offset, data):
+        return await self.run(self.handle.writeByte, FD, offset, data)
+
+    async def seek(self, FD, offset):
+        return await self.run(self.handle.seek, FD, offset)
+
+    async def stat(self, FD):
+        return await self.run(self.handle.stat, FD)
+
+    async def delete(self, FD):
+        return await self.run(self.handle.delete, FD)
+
+    async def fsync(self, FD):
+        return await self.run(self.handle.fsync, FD)
+
+    async def makeRO(self, name):
+        return await self.run(self.handle.makeRO, name)
+
+    async def makeRW(self, name):
+        return await self.run(self.handle.makeRW, name)
+
+    async def mkdir(self, path):
+        return await self.run(self.handle.mkdir, path)
+
+    async def rmdir(self, path):
+        return await self.run(self.handle.rmdir, path)
+
+    async def readdir(self, path="/"):
+        return await self.run(self.handle.readdir, path)
+
+
+def path_split(path):
+    # Splits a path into its names (empty ones from leading/doubled '/' are dropped)
+    return [name for name in path.split('/') if(len(name) > 0)]
+
+def name_valid(name):
+    # True if name fits a directory entry: ASCII, at most NAME_SIZE bytes
+    try:
+        return len(name.encode('ascii')) <= NAME_SIZE
+    except UnicodeEncodeError:
+        return False
+
+def dir_resolve(fs, names):
+    # Walks names down from the root directory, returns the last one's directory Inode or an error code
+    # Every name is checked up front: only NAME_SIZE bytes are compared, so a longer one would match a shorter one
+    if(not all(name_valid(name) for name in names)):
+        return ERR_INVALID_NAME
+    dinode = inode_load(fs, fs.root)
+    for name in names:
+        with dinode.lock.read():
+            FD = dir_lookup(fs, dinode, name)
+            bNum = inode_lookup(fs, FD) if FD >= 0 else FD
+        if(bNum < 0):
+            return ERR_FILE_NOT_FOUND
+        dinode = inode_load(fs, bNum)
+        if(dinode.type != MODE_DIR):
+            return ERR_NOT_DIR
+    return dinode
+
+def path_resolve(fs, path):
+    # Returns (directory Inode, name) for the last name in path, or an error code
+    names = path_split(path)
+    if(len(names) == 0):
+        return ERR_INVALID_NAME
+    leaf = names[-1]
+    if(not name_valid(leaf)):
+        return ERR_INVALID_NAME
+    dinode = dir_resolve(fs, names[:-1])
+    if(not isinstance(dinode, Inode)):
+        return dinode
+    return (dinode, leaf)
+
+def dir_entry(name, slot):
+    # Encodes a directory entry: name padded with 0's, then the inode table slot
+    entry = bytearray(INODE_ENTRY_SIZE)
+    entry[:len(name)] = name.encode('ascii')
+    entry[NAME_SIZE:] = slot.to_bytes(ADDR_SIZE, 'big')
+    return entry
+
+def dir_bucket(dinode, name):
+    # Index of the bucket (data block of the directory) that name hashes to
+    return zlib.crc32(name.encode('ascii')) & (len(dinode.blocks) - 1)
+
+def dir_init(fs, dinode):
+    # Writes out a new, empty directory: its one bucket block (all empty entries) and its inode
+    meta_write(fs, dinode.blocks[0], bytes(fs.block_size))
+    dinode.size = fs.block_size
+    inode_store(fs, dinode)
+
+def dir_lookup(fs, dinode, name):
+    # Returns the slot of name in the directory, or ERR_FILE_NOT_FOUND (reads one bucket block)
+    # A directory removed since it was looked up is empty
+    if(not inode_live(fs, dinode)):
+        return ERR_FILE_NOT_FOUND
+    bucket = bytearray(fs.block_size)
+    readBlock(fs.disk, dinode.blocks[dir_bucket(dinode, name)], bucket)
+    key = dir_entry(name, 0)[:NAME_SIZE]
+    for i in range(fs.entries_per_block):
+        entry = bucket[i*INODE_ENTRY_SIZE:(i+1)*INODE_ENTRY_SIZE]
+        if(entry[:NAME_SIZE] == key):
+            return int.from_bytes(bytes(entry[NAME_SIZE:]), 'big')
+    return ERR_FILE_NOT_FOUND
+
+def dir_add(fs, dinode, name, slot):
+    # Adds name -> slot to the directory, doubling its buckets while the one name hashes to is full
+    # Returns SUCCESS or an error code (the directory can't grow any more)
+    bucket = bytearray(fs.block_size)
+    empty = bytes(NAME_SIZE)
+    while(True):
+        bNum = dinode.blocks[dir_bucket(dinode, name)]
+        readBlock(fs.disk, bNum, bucket)
+        for i in range(fs.entries_per_block):
+            if(bucket[i*INODE_ENTRY_SIZE:i*INODE_ENTRY_SIZE+NAME_SIZE] == empty):
+                bucket[i*INODE_ENTRY_SIZE:(i+1)*INODE_ENTRY_SIZE] = dir_entry(name, slot)
+                meta_write(fs, bNum, bucket)
+                return SUCCESS
+        status = dir_split(fs, dinode)
+        if(status < 0):
+            return status
+
+def dir_split(fs, dinode):
+    # Doubles the directory's bucket count and rehashes every entry: entries of bucket b end up in b or b+N,
+    #   so no bucket can overflow. All buckets are read and written with one vectored call each.
+    bs = fs.block_size
+    nBuckets = len(dinode.blocks)
+    old = bytearray(nBuckets*bs)
+    readBlocks(fs.disk, dinode.blocks, old)
+    status = file_grow(fs, dinode, 2*nBuckets)
+    if(status < 0):
+        return status
+    region = bytearray(2*nBuckets*bs)
+    used = [0]*(2*nBuckets)
+    empty = bytes(NAME_SIZE)
+    for pos in range(nBuckets*fs.entries_per_block):
+        at = (int(pos / fs.entries_per_block)*bs) + ((pos % fs.entries_per_block)*INODE_ENTRY_SIZE)
+        entry = old[at:at+INODE_ENTRY_SIZE]
+        if(entry[:NAME_SIZE] == empty):
+            continue
+        b = dir_bucket(dinode, inode_parse_entry(entry)[0])
+        at = (b*bs) + (used[b]*INODE_ENTRY_SIZE)
+        region[at:at+INODE_ENTRY_SIZE] = entry
+        used[b] += 1
+    meta_writes(fs, dinode.blocks, region)
+    dinode.size = len(dinode.blocks)*bs
+    inode_store(fs, dinode)
+    return SUCCESS
 
-    if(f.offset >= size):
-        return ERR_INVALID_OFFSET
+def dir_remove(fs, dinode, name):
+    # Clears name's entry from the directory
+    bucket = bytearray(fs.block_size)
+    bNum = dinode.blocks[dir_bucket(dinode, name)]
+    readBlock(fs.disk, bNum, bucket)
+    key = dir_entry(name, 0)[:NAME_SIZE]
+    for i in range(fs.entries_per_block):
+        if(bucket[i*INODE_ENTRY_SIZE:i*INODE_ENTRY_SIZE+NAME_SIZE] == key):
+            bucket[i*INODE_ENTRY_SIZE:(i+1)*INODE_ENTRY_SIZE] = bytes(INODE_ENTRY_SIZE)
+            meta_write(fs, bNum, bucket)
+            return
+
+def dir_list(fs, dinode):
+    # Returns every (name, slot) in the directory, bucket by bucket (one vectored read)
+    bs = fs.block_size
+    region = bytearray(len(dinode.blocks)*bs)
+    readBlocks(fs.disk, dinode.blocks, region)
+    empty = bytes(NAME_SIZE)
+    entries = []
+    for b in range(len(dinode.blocks)):
+        for i in range(fs.entries_per_block):
+            pos = (b*bs) + (i*INODE_ENTRY_SIZE)
+            if(region[pos:pos+NAME_SIZE] != empty):
+                entries.append(inode_parse_entry(region[pos:pos+INODE_ENTRY_SIZE]))
+    return entries
+
+def inode_create(fs, dinode, name, itype):
+    # Creates a new inode (directories get an empty first bucket too), gives it the lowest free inode table
+    #   slot and adds it to directory dinode as name. Returns the slot or an error code.
+    # Find free block(s) on disk to put the inode (and bucket) on
+    nBlocks = 2 if itype == MODE_DIR else 1
+    bNums = []
+    if(not free_blocks_wait(fs, nBlocks)):
+        return ERR_NO_FREEBLOCKS
+    with fs.alloc_lock:
+        if(nBlocks > fs.free_blocks):
+            return ERR_NO_FREEBLOCKS
+        for i in range(nBlocks):
+            bNum = find_freeblock(fs)
+            remove_freeblock(fs, bNum)
+            bNums.append(bNum)
+        bitmap_sync(fs)
+    # Take the lowest free inode table slot from the in-memory free list, growing the table if there is none
+    with fs.table_lock:
+        if((len(fs.free_slots) == 0) and (table_grow(fs) < 0)):
+            with fs.alloc_lock:
+                for bNum in bNums:
+                    add_freeblock(fs, bNum)
+                bitmap_sync(fs)
+            return ERR_NO_FREEBLOCKS
+        FD = heapq.heappop(fs.free_slots)
+    new_inode = Inode(bNums[0], itype)      # Creation time is now
+    if(itype == MODE_DIR):
+        new_inode.blocks.append(bNums[1])
+        dir_init(fs, new_inode)
+    else:
+        new_inode.data = bytearray()        # Files start out inline
+        inode_store(fs, new_inode)
+
+    # inode has been created and written on disk, update inode table (same layout as a directory entry, with
+    #   the inode block in place of the slot) and the directory
+    inode_entry = dir_entry(name, bNums[0])
+    with fs.table_lock:
+        inode_write_entry(fs, FD, inode_entry)
+        fs.slots[FD] = (name, bNums[0])
+    status = dir_add(fs, dinode, name, FD)
+    if(status < 0):                         # Directory is full: undo all of it
+        inode_destroy(fs, FD, new_inode)
+        return status
+    return FD
+
+def inode_destroy(fs, FD, inode):
+    # Frees an inode's data, indirect and inode blocks and its inode table slot
+    bNums = list(inode.blocks)
+    bNums.extend(inode.ptrs)
+    bNums.append(inode.bNum)
 
-    # Offset is valid, find which data block byte is in
-    dbNums = inode_get_blocks(inode_block)
-    dbNum = dbNums[int(f.offset / BLOCKSIZE)]
-    dbOffset = int(f.offset % BLOCKSIZE)
+    # Add inode and data blocks back to freeblock bitmap
+    with fs.alloc_lock:
+        for bNum in bNums:
+            add_freeblock(fs, bNum)
+        bitmap_sync(fs)
+    fs.inodes.pop(inode.bNum, None)         # Nothing left to persist it to
+    inode_remove_entry(fs, FD)
 
-    data_block = bytearray(BLOCKSIZE)
-    readBlock(curr_FS.disk, dbNum, data_block)
+def inode_parse_entry(inode_entry):
+    # Parses inode entry and returns tuple of (name, index)
+    name = bytes(inode_entry[:NAME_SIZE]).rstrip(b'\x00').decode('ascii')
+    index = int.from_bytes(bytes(inode_entry[NAME_SIZE:NAME_SIZE+ADDR_SIZE]), 'big')
+    return (name, index)
 
-    # Once you have data block, put byte into buffer & increment offset
-    buffer[0] = data_block[dbOffset]
-    f.offset += 1
+def index_load(fs):
+    # Builds the in-memory slot index and free slot list from one pass over the inode table
+    # FD/table slot -> (name, inode block), plus a heap of free slots (lowest reused first)
+    # The table is read by following its chain from the first table block
+    fs.slots = {}
+    fs.free_slots = []
+    fs.table_blocks = []
+    table_block = bytearray(fs.block_size)
+    empty = bytes(INODE_ENTRY_SIZE)
+    bNum = fs.table_start
+    while((bNum != 0) and (len(fs.table_blocks) < fs.nBlocks)):
+        readBlock(fs.disk, bNum, table_block)
+        table_bNum = len(fs.table_blocks)
+        fs.table_blocks.append(bNum)
+        bNum = int.from_bytes(bytes(table_block[-ADDR_SIZE:]), 'big')
+        for i in range(fs.entries_per_block):
+            FD = (table_bNum*fs.entries_per_block) + i
+            inode_entry = table_block[(i*INODE_ENTRY_SIZE):((i+1)*INODE_ENTRY_SIZE)]
+            if(inode_entry == empty):
+                fs.free_slots.append(FD)
+                continue
+            fs.slots[FD] = inode_parse_entry(inode_entry)
+    heapq.heapify(fs.free_slots)
+
+def table_grow(fs):
+    # Adds INODE_TABLE_SIZE empty blocks from the data region to the end of the inode table, chaining them on
+    #   after its last block. Their slots go on the free list. Returns SUCCESS or ERR_NO_FREEBLOCKS.
+    # Called with fs.table_lock held
+    bs = fs.block_size
+    if(not free_blocks_wait(fs, INODE_TABLE_SIZE)):
+        return ERR_NO_FREEBLOCKS
+    with fs.alloc_lock:
+        extents = alloc_extents(fs, INODE_TABLE_SIZE)
+    if(extents == ERR_NO_FREEBLOCKS):
+        return ERR_NO_FREEBLOCKS
+    bNums = []
+    for start, length in extents:
+        bNums.extend(range(start, start+length))
+    region = bytearray(len(bNums)*bs)
+    for i in range(len(bNums) - 1):
+        region[((i+1)*bs)-ADDR_SIZE:(i+1)*bs] = bNums[i+1].to_bytes(ADDR_SIZE, 'big')
+    meta_writes(fs, bNums, region)
+
+    # Link the old last block to the first new one
+    last = bytearray(bs)
+    readBlock(fs.disk, fs.table_blocks[-1], last)
+    last[-ADDR_SIZE:] = bNums[0].to_bytes(ADDR_SIZE, 'big')
+    meta_write(fs, fs.table_blocks[-1], last)
+    bitmap_sync(fs)
+
+    first = len(fs.table_blocks)*fs.entries_per_block
+    fs.table_blocks.extend(bNums)
+    for FD in range(first, len(fs.table_blocks)*fs.entries_per_block):
+        heapq.heappush(fs.free_slots, FD)
+    return SUCCESS
 
-    # Update inode block with new access time
-    inode_bNum = inode_parse_entry(inode_get_entry(FD))[INODE_ENTRY_INDEX]
-    inode_set_data(inode_block, INODE_ATIME, INODE_SIZE_TIME, int(time.time()))
-    writeBlock(curr_FS.disk, inode_bNum, inode_block)
+def inode_lookup(fs, FD):
+    # Given FD, return the block number of its inode straight from the slot index (no inode table read)
+    entry = fs.slots.get(FD)
+    if(entry is None):
+        return ERR_INVALID_FD
+    return entry[1]
+
+def inode_write_entry(fs, FD, inode_entry):
+    # Writes a 12-byte inode entry into FD's slot in the inode table
+    table_bNum = int(FD / fs.entries_per_block)
+    inode_offset = (FD % fs.entries_per_block)*INODE_ENTRY_SIZE
+    inode_block = bytearray(fs.block_size)
+    with fs.table_lock:                     # Other slots in the same block may be changing too
+        readBlock(fs.disk, fs.table_blocks[table_bNum], inode_block)
+        inode_block[inode_offset:inode_offset+INODE_ENTRY_SIZE] = inode_entry
+        meta_write(fs, fs.table_blocks[table_bNum], inode_block)
+
+def inode_remove_entry(fs, FD):
+    # Clears FD's inode table slot and drops it from the slot index, making the slot free again
+    with fs.table_lock:
+        inode_write_entry(fs, FD, bytes(INODE_ENTRY_SIZE))
+        if(fs.slots.pop(FD, None) is not None):
+            heapq.heappush(fs.free_slots, FD)
+
+def inode_load(fs, bNum):
+    # Returns the Inode stored in block bNum, decoding it from disk only on the first use this mount
+    # Indirect blocks are read here too, so the full block list is in memory and lookups by offset are O(1)
+    inode = fs.inodes.get(bNum)
+    if(inode is None):
+        block = bytearray(fs.block_size)
+        readBlock(fs.disk, bNum, block)
+        inode = Inode(bNum)
+        nBlocks = inode.unpack(fs, block)
+        remaining = nBlocks - len(inode.blocks)
+        if(remaining > 0):                  # Single indirect
+            readBlock(fs.disk, inode.ptrs[0], block)
+            inode.blocks.extend(bnums_unpack(block[:min(remaining, fs.ptrs_per_block)*ADDR_SIZE]))
+            remaining -= fs.ptrs_per_block
+        if(remaining > 0):                  # Double indirect, then all of its children in one vectored read
+            readBlock(fs.disk, inode.ptrs[1], block)
+            nChildren = ptr_blocks_needed(fs, nBlocks) - 2
+            inode.ptrs.extend(bnums_unpack(block[:nChildren*ADDR_SIZE]))
+            children = bytearray(nChildren*fs.block_size)
+            readBlocks(fs.disk, inode.ptrs[2:], children)
+            inode.blocks.extend(bnums_unpack(children[:remaining*ADDR_SIZE]))
+        inode = fs.inodes.setdefault(bNum, inode)  # Whoever loaded it first wins, so there's one lock per inode
+    return inode
 
-# change the file pointer location to offset (absolute). Returns success/error codes.
-def tfs_seek(FD, offset):
-    # Make sure FS is actually mounted
-    if(not mounted):
-        return ERR_MOUNTED_NONE
-    f = curr_FS.files[FD]
+def inode_set_blocks(fs, inode, bNums, first=0):
+    # Replaces the inode's data block list, (de)allocating and rewriting its indirect blocks to match
+    # first is the index of the first entry that differs from the current list: indirect blocks only holding
+    #   entries before it are left alone
+    # Returns SUCCESS, or ERR_NO_FREEBLOCKS if there's no room for the indirect blocks
+    nPtrs = ptr_blocks_needed(fs, len(bNums))
+    oldPtrs = len(inode.ptrs)
+    with fs.alloc_lock:
+        if(nPtrs > len(inode.ptrs)):
+            extents = alloc_extents(fs, nPtrs - len(inode.ptrs))
+            if(extents == ERR_NO_FREEBLOCKS):
+                return ERR_NO_FREEBLOCKS
+            for start, length in extents:
+                inode.ptrs.extend(range(start, start+length))
+        while(len(inode.ptrs) > nPtrs):
+            add_freeblock(fs, inode.ptrs.pop())
+    inode.blocks = array(BNUM_TYPECODE, bNums)
+
+    # Lay out every changed indirect block back to back and write them together
+    # ptrs[0] holds entries from direct_blocks on, ptrs[1] the list of children, child ptrs[i] the i-1'th
+    #   group of ptrs_per_block entries after the single indirect's
+    changed = []
+    for i in range(nPtrs):
+        if(i == 1):
+            if(nPtrs != oldPtrs):
+                changed.append(i)
+            continue
+        last = fs.direct_blocks + (max(i, 1)*fs.ptrs_per_block)   # One past the last entry ptrs[i] holds
+        if((i >= oldPtrs) or (first < last)):
+            changed.append(i)
+    if(len(changed) > 0):
+        bs = fs.block_size
+        region = bytearray(len(changed)*bs)
+        for pos in range(len(changed)):
+            i = changed[pos]
+            if(i == 1):
+                raw = bnums_pack(inode.ptrs[2:])
+            else:
+                start = fs.direct_blocks + ((max(i, 1)-1)*fs.ptrs_per_block)
+                raw = bnums_pack(inode.blocks[start:start+fs.ptrs_per_block])
+            region[pos*bs:(pos*bs)+len(raw)] = raw
+        meta_writes(fs, [inode.ptrs[i] for i in changed], region)
+    return SUCCESS
 
-    # Get size of file from inode
-    inode_block = inode_get_block(FD)
-    size_bytes = inode_block[2:4]
-    size = (size_bytes[0] << 8) | (size_bytes[1])
+def inode_store(fs, inode):
+    # Writes the inode to its block now and caches it
+    meta_write(fs, inode.bNum, inode.pack(fs))
+    inode.dirty = False
+    fs.inodes[inode.bNum] = inode
+
+def inode_sync(fs, inode=None):
+    # Writes back the given inode, or every cached inode, if it has changes only held in memory
+    if(inode is not None):
+        if(inode.dirty):
+            inode_store(fs, inode)
+        return
+    for cached in fs.inodes.values():
+        if(cached.dirty):
+            inode_store(fs, cached)
+
+def inode_touch(fs, inode, modified):
+    # Records an access (and a modification, if modified) of inode according to fs.atime_policy
+    # Strict: the inode is written now. Otherwise it's only marked dirty and written at close/unmount.
+    now = int(time.time())
+    if(modified):
+        inode.mtime = now
+    if(fs.atime_policy == ATIME_STRICT):
+        inode.atime = now
+        inode_store(fs, inode)
+        return
+    if(fs.atime_policy == ATIME_RELATIME):
+        if((inode.atime < inode.mtime) or ((now - inode.atime) >= fs.relatime_age)):
+            inode.atime = now
+            inode.dirty = True
+    if(modified):
+        inode.dirty = True
+
+def file_grow(fs, inode, nBlocks):
+    # Extends the inode's block list to nBlocks data blocks; the new ones go right after its last block if free
+    # Only the indirect blocks that change are rewritten. Returns SUCCESS or an error code.
+    have = len(inode.blocks)
+    if(nBlocks <= have):
+        return SUCCESS
+    if(nBlocks > fs.max_dblocks):
+        return ERR_FILE_TOO_LARGE
+    needed = (nBlocks - have) + max(ptr_blocks_needed(fs, nBlocks) - len(inode.ptrs), 0)
+    if(not free_blocks_wait(fs, needed)):
+        return ERR_NO_FREEBLOCKS
+    with fs.alloc_lock:
+        if(needed > fs.free_blocks):
+            return ERR_NO_FREEBLOCKS
+        if(have > 0):
+            fs.bitmap_cursor = inode.blocks[-1] + 1
+        extents = alloc_extents(fs, nBlocks - have)
+    if(extents == ERR_NO_FREEBLOCKS):
+        return ERR_NO_FREEBLOCKS
+    bNums = list(inode.blocks)
+    for start, length in extents:
+        bNums.extend(range(start, start+length))
+    status = inode_set_blocks(fs, inode, bNums, have)
+    if(status == ERR_NO_FREEBLOCKS):        # Another thread took the blocks the indirect blocks needed
+        with fs.alloc_lock:
+            for bNum in bNums[have:]:
+                add_freeblock(fs, bNum)
+    bitmap_sync(fs)                         # All the bitmap changes go out together
+    return status
+
+def file_shrink(fs, inode, nBlocks):
+    # Frees the inode's data blocks (and indirect blocks) past the first nBlocks
+    if(nBlocks >= len(inode.blocks)):
+        return
+    with fs.alloc_lock:
+        for bNum in inode.blocks[nBlocks:]:
+            add_freeblock(fs, bNum)
+    inode_set_blocks(fs, inode, inode.blocks[:nBlocks], nBlocks)
+    bitmap_sync(fs)
+
+def file_write(fs, inode, view, offset):
+    # Writes the bytes in view into the file at offset, growing it if the write runs past the end
+    # Whole blocks go straight from view to disk; only a partial head/tail block is read, patched and written back
+    #   (and only read if it holds file data). Returns the number of bytes written or an error code.
+    bs = fs.block_size
+    count = len(view)
+    end = offset + count
+    if(end > fs.max_filesize):
+        return ERR_FILE_TOO_LARGE
+    if(count == 0):
+        return 0
+    if(inode.data is not None):
+        if(end <= fs.inline_max):           # Still fits in the inode: nothing but the inode to write
+            inode.data[offset:end] = view
+            inode.size = len(inode.data)
+            return count
+        status = file_promote(fs, inode)
+        if(status < 0):
+            return status
+    oldSize = inode.size
+    status = file_grow(fs, inode, int(ceil(end / float(bs))))
+    if(status < 0):
+        return status
+    dbNums = inode.blocks
+
+    idx = int(offset / bs)
+    lo = offset % bs
+    pos = 0
+    if((lo != 0) or (count < bs)):          # Partial head block
+        pos = min(bs - lo, count)
+        scratch = bytearray(bs)
+        if(idx*bs < oldSize):
+            readBlock(fs.disk, dbNums[idx], scratch)
+        scratch[lo:lo+pos] = view[:pos]
+        writeBlock(fs.disk, dbNums[idx], scratch)
+        idx += 1
+    nFull = int((count - pos) / bs)
+    if(nFull > 0):
+        writeBlocks(fs.disk, dbNums[idx:idx+nFull], view[pos:pos+(nFull*bs)])
+        pos += nFull*bs
+        idx += nFull
+    if(pos < count):                        # Partial tail block
+        scratch = bytearray(bs)
+        if(idx*bs < oldSize):
+            readBlock(fs.disk, dbNums[idx], scratch)
+        scratch[:count-pos] = view[pos:count]
+        writeBlock(fs.disk, dbNums[idx], scratch)
+    inode.size = max(oldSize, end)
+    return count
+
+def file_flush(fs, FD):
+    # Writes an open file's buffered blocks out in file order (contiguous runs together), then its inode
+    #   according to the atime policy (once for the whole batch)
+    f = fs.files.get(FD)
+    if((f is None) or (len(f.wbuf) == 0)):
+        return
+    bs = fs.block_size
+    inode = inode_load(fs, inode_lookup(fs, FD))
+    order = sorted(f.wbuf)
+    region = bytearray(len(order)*bs)
+    for pos in range(len(order)):
+        region[pos*bs:(pos+1)*bs] = f.wbuf[order[pos]]
+    writeBlocks(fs.disk, [inode.blocks[idx] for idx in order], region)
+    f.wbuf = {}
+    readahead_drop(f)
+    inode_touch(fs, inode, True)
+
+def file_promote(fs, inode):
+    # Moves an inline file's data out of its inode into a data block of its own
+    data = inode.data
+    inode.data = None
+    if(len(data) == 0):
+        return SUCCESS
+    status = file_grow(fs, inode, 1)
+    if(status < 0):
+        inode.data = data
+        return status
+    block = bytearray(fs.block_size)
+    block[:len(data)] = data
+    writeBlock(fs.disk, inode.blocks[0], block)
+    return SUCCESS
 
-    # Make sure you're not trying to seek past EOF
-    if(offset >= size):
-        return ERR_INVALID_SEEK
+def file_buffer(fs, FD, inode, offset, data):
+    # Puts a write that stays inside one existing block of the file into the file's write buffer
+    # The block is read once when it enters the buffer; a full buffer is flushed first
+    # Inline files are changed in the inode, which is written at the next flush/close like a buffered block
+    if(inode.data is not None):
+        inode.data[offset:offset+len(data)] = data
+        inode.mtime = int(time.time())
+        inode.dirty = True
+        return
+    f = fs.files[FD]
+    bs = fs.block_size
+    idx = int(offset / bs)
+    block = f.wbuf.get(idx)
+    if(block is None):
+        if(len(f.wbuf) >= WRITE_BUFFER_BLOCKS):
+            file_flush(fs, FD)
+        block = bytearray(bs)
+        readBlock(fs.disk, inode.blocks[idx], block)
+        f.wbuf[idx] = block
+    lo = offset % bs
+    block[lo:lo+len(data)] = data
+    inode.mtime = int(time.time())          # Inode itself is written when the buffer is flushed
+    inode.dirty = True
+
+def readahead_block(fs, f, inode, idx):
+    # Returns a view of the file's block idx, out of the open file's read-ahead buffer
+    # A miss refills the buffer with one vectored read: while reads move forward block by block the window
+    #   doubles (up to READAHEAD_MAX_BLOCKS), any other access starts it over at READAHEAD_MIN_BLOCKS
+    bs = fs.block_size
+    sequential = (idx == f.ra_last) or (idx == f.ra_last + 1)
+    if(not (f.ra_start <= idx < f.ra_start + int(len(f.ra_buf) / bs))):
+        if(sequential):
+            f.ra_window = min(2*f.ra_window, READAHEAD_MAX_BLOCKS)
+        else:
+            f.ra_window = READAHEAD_MIN_BLOCKS
+        count = min(f.ra_window, len(inode.blocks) - idx)
+        f.ra_buf = bytearray(count*bs)
+        f.ra_start = idx
+        readBlocks(fs.disk, inode.blocks[idx:idx+count], f.ra_buf)
+    f.ra_last = idx
+    start = (idx - f.ra_start)*bs
+    return memoryview(f.ra_buf)[start:start+bs]
+
+def readahead_drop(f):
+    # Forgets the open file's prefetched blocks (its blocks on disk just changed)
+    f.ra_buf = bytearray()
+
+def create_superblock(fs):
+    # Creates the superblock and the free blocks bitmap, and writes them to disk together
+    # The superblock only holds the header (see SUPERBLOCK_HEADER), the bitmap has a region of its own
+    #   right after it, sized so every block on the disk has a bit. The (empty) inode table follows.
+    bs = fs.block_size
+    region = bytearray(fs.data_start*bs)
+    SUPERBLOCK_HEADER.pack_into(region, 0, MAGIC_NUMBER, bs.bit_length() - 1, fs.journal_blocks, fs.table_start,
+        fs.bitmap_blocks, fs.data_start, fs.nBlocks, fs.root)
+
+    # Every data region block but the root directory's two starts out free, the metadata blocks before it
+    #   never are (MSB first)
+    nbits = 8*fs.bitmap_blocks*bs
+    free = fs.nBlocks - fs.data_start - 2
+    bits = ((1 << free) - 1) << (nbits - fs.nBlocks)
+    region[bs:fs.table_start*bs] = bits.to_bytes(fs.bitmap_blocks*bs, 'big')
+
+    # Chain the inode table blocks together
+    for bNum in range(fs.table_start, fs.journal_start - 1):
+        region[((bNum+1)*bs)-ADDR_SIZE:(bNum+1)*bs] = (bNum+1).to_bytes(ADDR_SIZE, 'big')
+
+    # Empty journal: replay starts at the first transaction
+    if(fs.journal_blocks > 0):
+        JOURNAL_BLOCK.pack_into(region, fs.journal_start*bs, JOURNAL_MAGIC, JBLOCK_HEADER, 1, 0)
+
+    # Write superblock, bitmap, inode table and journal blocks in one go
+    writeBlocks(fs.disk, list(range(fs.data_start)), region)
+    return SUCCESS
+    
+def meta_write(fs, bNum, block):
+    # Writes one metadata block, see meta_writes
+    return meta_writes(fs, [bNum], block)
+
+def meta_writes(fs, bNums, buf):
+    # Writes metadata blocks (inodes, directory buckets, indirect, inode table and bitmap blocks): logged in the
+    #   running journal transaction if the FS has a journal, straight to disk otherwise
+    if(fs.journal is None):
+        return writeBlocks(fs.disk, bNums, buf)
+    return journal_log(fs.journal, bNums, buf)
+
+def journal_open(fs, window, sync):
+    # Replays fs's journal (mount, before anything is read off the disk) and attaches a fresh Journal to fs
+    journal = Journal(fs, window, sync)
+    journal_replay(journal)
+    fs.journal = journal
+
+def journal_start(journal):
+    # Starts the committer thread
+    journal.thread = threading.Thread(target=journal_run, args=(journal,), name="tinyfs-journal", daemon=True)
+    journal.thread.start()
+
+def journal_close(journal):
+    # Unmount: stops the committer, commits everything still logged and empties the journal (nothing left for
+    #   the next mount to replay). Called with no operations running.
+    with journal.lock:
+        journal.stopping = True
+        journal.cond.notify_all()
+    journal.thread.join()
+    while(journal_pending(journal)):
+        journal_commit(journal)
+    journal_apply(journal)
+    fs = journal.fs
+    syncDisk(fs.disk)
+    journal_reset(journal)
+    fs.journal = None
+
+def journal_pending(journal):
+    # True if the running transaction has anything in it
+    return (len(journal.running) > 0) or (len(journal.revoked) > 0) or (len(journal.freeing) > 0)
+
+def journal_begin(journal):
+    # Starts a handle for the calling thread's operation (nested ones are part of it). Waits while a commit
+    #   drains the running transaction, the operation then goes in the next one.
+    local = journal.local
+    depth = getattr(local, 'depth', 0)
+    if(depth == 0):
+        with journal.lock:
+            while(journal.draining):
+                journal.cond.wait()
+            journal.active += 1
+        local.tid = None
+    local.depth = depth + 1
+
+def journal_end(journal):
+    # Ends the calling thread's handle. Returns the tid its operation has to wait for before returning (sync
+    #   mounts, or see journal_want), or None.
+    local = journal.local
+    local.depth -= 1
+    if(local.depth > 0):
+        return None
+    with journal.lock:
+        journal.active -= 1
+        journal.ops += 1
+        if(journal.draining and (journal.active == 0)):
+            journal.cond.notify_all()
+    tid = local.tid
+    local.tid = None
+    if((tid is not None) and (journal.sync or getattr(local, 'want', False))):
+        local.want = False
+        return tid
+    local.want = False
+    return None
+
+def journal_want(journal):
+    # The calling thread's operation only returns once everything logged so far is committed, which the
+    #   committer does right away instead of at the end of the window
+    with journal.lock:
+        if(journal_pending(journal)):
+            journal.local.tid = journal.tid
+            journal.first = time.monotonic() - journal.window
+            journal.cond.notify_all()
+        elif(journal.committed < journal.tid - 1):  # Still being committed
+            journal.local.tid = journal.tid - 1
+    journal.local.want = True
+
+def journal_wait(journal, tid):
+    # Waits until transaction tid is durable
+    with journal.lock:
+        while(journal.committed < tid):
+            journal.cond.wait()
+
+def journal_log(journal, bNums, buf):
+    # Adds block images to the running transaction (an image of a block already in it replaces the old one)
+    #   and holds them (see holdBlocks): reads get them right away, they're only written in place once it
+    #   commits. If the transaction would outgrow the journal it is committed first, operations that are
+    #   halfway included (and a single write that big is split over several transactions).
+    bs = journal.fs.block_size
+    view = blockView(buf)
+    pos = 0
+    while(pos < len(bNums)):
+        with journal.lock:
+            room = journal_room(journal)
+            if((room <= 0) and journal_pending(journal)):
+                full = True
+            else:
+                full = False
+                count = min(max(room, 1), len(bNums) - pos)
+                images = holdBlocks(journal.fs.disk, bNums[pos:pos+count], view[pos*bs:(pos+count)*bs])
+                for i in range(count):
+                    journal.running[bNums[pos+i]] = images[i]
+                    journal.logged[bNums[pos+i]] = journal.tid
+                if(journal.first is None):
+                    journal.first = time.monotonic()
+                    journal.cond.notify_all()
+                journal.local.tid = journal.tid
+        if(full):
+            journal_commit(journal, False)
+            continue
+        pos += count
+    return SUCCESS
 
-    f.offset = offset
+def journal_room(journal):
+    # How many more block images the running transaction can take and still fit in the journal with its
+    #   descriptor, revoke and commit blocks (called with journal.lock held)
+    per_block = int((journal.fs.block_size - JOURNAL_BLOCK.size) / ADDR_SIZE)
+    revokes = int(ceil((len(journal.revoked) + 1) / float(per_block)))     # +1: a free may come before commit
+    spare = journal.nBlocks - 1 - revokes - 1      # Header, revoke blocks, commit block
+    return int((spare*per_block) / (per_block + 1)) - len(journal.running)
+
+def journal_free(journal, bNum):
+    # Block bNum was freed (called with fs.alloc_lock held): the bitmap logged in the running transaction
+    #   shows it free (see bitmap_sync), but in memory it stays allocated until that transaction commits, so
+    #   it can't be reused before then. If it has an image in the journal that image is revoked, so a replay
+    #   doesn't write it over whatever the block holds by then.
+    journal.fs.bitmap_dirty.add(bitmap_locate(journal.fs, bNum))
+    with journal.lock:
+        journal.freeing.append(bNum)
+        if(bNum in journal.logged):
+            journal.revoked.add(bNum)
+        if(journal.first is None):
+            journal.first = time.monotonic()
+            journal.cond.notify_all()
+
+def free_blocks_wait(fs, nBlocks):
+    # True if at least nBlocks blocks are free. With a journal, blocks freed by transactions that haven't
+    #   committed yet don't count (see journal_free): if there are any the running transaction is committed
+    #   right away and the ones being freed are waited for.
+    # Called without fs.alloc_lock held
+    if(nBlocks <= fs.free_blocks):
+        return True
+    journal = fs.journal
+    if(journal is not None):
+        if(len(journal.freeing) > 0):
+            journal_commit(journal, False)
+        journal_apply(journal)
+        with journal.lock:
+            while(journal.unapplied > 0):
+                journal.cond.wait()
+    return nBlocks <= fs.free_blocks
+
+def journal_run(journal):
+    # Committer thread: commits the running transaction window seconds after its first block was logged, and
+    #   frees the blocks committed transactions freed
+    while(True):
+        with journal.lock:
+            while((journal.first is None) and (len(journal.to_free) == 0) and (not journal.stopping)):
+                journal.cond.wait()
+            if(journal.stopping):           # journal_close commits the rest
+                return
+            delay = 0 if(journal.first is None) else (journal.first + journal.window - time.monotonic())
+            if(delay > 0):
+                journal.cond.wait(delay)
+                continue
+        journal_commit(journal)
+        journal_apply(journal)
+
+def journal_commit(journal, drain=True):
+    # Commits the running transaction: its images, revokes and commit block are written to the journal after
+    #   the last transaction's and one fsync makes it durable. Then the images are written in place, the
+    #   blocks it freed are left for journal_apply.
+    # drain first waits for the operations logging into it to end (they're part of it), so it only ever holds
+    #   whole operations. Without drain (from inside an operation) it goes as it is.
+    fs = journal.fs
+    bs = fs.block_size
+    with journal.lock:
+        if(drain):
+            while(journal.draining):        # Someone else is draining it already
+                journal.cond.wait()
+            journal.draining = True
+            while(journal.active > 0):
+                journal.cond.wait()
+            journal.draining = False
+            journal.cond.notify_all()
+        if(not journal_pending(journal)):
+            return SUCCESS
+        tid = journal.tid
+        running = journal.running
+        revoked = journal.revoked
+        freeing = journal.freeing
+        journal.tid += 1
+        journal.running = {}
+        journal.revoked = set()
+        journal.freeing = []
+        journal.committing[tid] = freeing
+        journal.first = None
+        while(journal.written < tid - 1):   # Transactions go to the journal in tid order
+            journal.cond.wait()
+
+    # Descriptor blocks, each followed by the images it lists, then revoke blocks
+    per_block = int((bs - JOURNAL_BLOCK.size) / ADDR_SIZE)
+    bNums = sorted(running)
+    images = [running[bNum] for bNum in bNums]
+    records = []
+    for kind, listed in ((JBLOCK_DESCRIPTOR, bNums), (JBLOCK_REVOKE, sorted(revoked))):
+        for first in range(0, len(listed), per_block):
+            group = listed[first:first+per_block]
+            record = bytearray(bs)
+            JOURNAL_BLOCK.pack_into(record, 0, JOURNAL_MAGIC, kind, tid, len(group))
+            raw = bnums_pack(group)
+            record[JOURNAL_BLOCK.size:JOURNAL_BLOCK.size+len(raw)] = raw
+            records.append(record)
+            if(kind == JBLOCK_DESCRIPTOR):
+                records.extend(images[first:first+per_block])
+    crc = 0
+    for record in records:
+        crc = zlib.crc32(record, crc)
+    commit = bytearray(bs)
+    JOURNAL_BLOCK.pack_into(commit, 0, JOURNAL_MAGIC, JBLOCK_COMMIT, tid, len(records))
+    commit[JOURNAL_BLOCK.size:JOURNAL_BLOCK.size+4] = crc.to_bytes(4, 'big')
+    records.append(commit)
+
+    # Ordered: file data written so far goes to disk (and is durable) before the metadata pointing at it commits.
+    #   Otherwise a committed inode could point at blocks still holding whatever they held before, like the bytes
+    #   of a deleted file.
+    stats = cacheStats(fs.disk)
+    if((stats is not None) and (stats["dirty"] > 0)):
+        flushDisk(fs.disk)
+
+    if(len(records) >= journal.nBlocks):
+        # Too big for even an empty journal (lots of revokes): once the journal is emptied, so nothing older
+        #   gets replayed over it, the images are written in place directly. Not atomic, but durable.
+        syncDisk(fs.disk)
+        journal_reset(journal, tid + 1)
+        releaseBlocks(fs.disk, bNums, images)
+        syncDisk(fs.disk)
+    else:
+        if(journal.head + len(records) > journal.nBlocks):
+            # Journal full: everything committed so far is in place already, once that's durable the journal
+            #   starts over with this transaction (the header goes out with it)
+            syncDisk(fs.disk)
+            with journal.lock:
+                journal.logged = {bNum: logged for bNum, logged in journal.logged.items() if(logged >= tid)}
+            header = bytearray(bs)
+            JOURNAL_BLOCK.pack_into(header, 0, JOURNAL_MAGIC, JBLOCK_HEADER, tid, 0)
+            records.insert(0, header)
+            journal.head = 0
+        logBlocks(fs.disk, journal.start + journal.head, records)
+        syncDisk(fs.disk)                   # Committed
+        journal.head += len(records)
+        releaseBlocks(fs.disk, bNums, images)
+
+    with journal.lock:
+        journal.written = tid
+        journal.committed = tid
+        journal.commits += 1
+        journal.blocks += len(bNums)
+        journal.to_free.extend(journal.committing.pop(tid))
+        journal.unapplied += len(freeing)
+        journal.cond.notify_all()
     return SUCCESS
 
-def create_superblock(disk, addr_size, nBlocks, freeBlocks):
-    # Creates superblock and free blocks bitmap, and write them to memory
-    # 0 byte = Magic Number, 1 byte = how many blocks needed for free block bitmap, next 4 bytes = root inode addr
-    # Returns the number of extra blocks needed to create the free block bitmap
-    superblock = [0x00] * BLOCKSIZE
-    superblock[0] = MAGIC_NUMBER            # Add magic number at first byte
-
-    # Add block number for root directory inode
-    superblock[1] = ROOT_DIR_BLOCK
-
-    # Create bitmap for free blocks
-    bitmap_len = freeBlocks                 # How many freeblocks (bits) needed for bitmap
-    bits_left = 8*(BLOCKSIZE-(2+addr_size)) # Bits left in superblock for bitmap    
-    if(bitmap_len > bits_left):             # Check if more blocks needed for bitmap
-        extra_blocks = int(ceil((bitmap_len-bits_left)/float(8*BLOCKSIZE)))
+def journal_apply(journal):
+    # Marks the blocks committed transactions freed as free in memory, so they can be allocated again (the
+    #   bitmap those transactions logged has them free already)
+    fs = journal.fs
+    with fs.alloc_lock:                     # Taken first, so bitmap_sync always sees them as freed one way or
+        with journal.lock:                  #   the other
+            freeing = journal.to_free
+            journal.to_free = []
+        if(len(freeing) == 0):
+            return
+        for start, run in blockRuns(sorted(set(freeing))):
+            bitmap_mark(fs, start, len(run), True)
+    with journal.lock:
+        journal.unapplied -= len(freeing)
+        journal.cond.notify_all()
+
+def journal_reset(journal, tid=None):
+    # Empties the journal: the next transaction to replay is tid (default: the running one). Only once
+    #   everything committed is durable in place.
+    if(tid is None):
+        tid = journal.tid
+    header = bytearray(journal.fs.block_size)
+    JOURNAL_BLOCK.pack_into(header, 0, JOURNAL_MAGIC, JBLOCK_HEADER, tid, 0)
+    logBlocks(journal.fs.disk, journal.start, [header])
+    syncDisk(journal.fs.disk)
+    journal.head = 1
+    with journal.lock:
+        journal.logged = {bNum: logged for bNum, logged in journal.logged.items() if(logged >= tid)}
+
+def journal_replay(journal):
+    # Writes the block images of every committed transaction in the journal in place (in tid order, leaving
+    #   out revoked ones), makes them durable and empties the journal. Reading stops at the first transaction
+    #   that isn't complete (crash before its commit block was written) or doesn't match its checksum.
+    # Returns the number of transactions replayed
+    fs = journal.fs
+    bs = fs.block_size
+    region = bytearray(journal.nBlocks*bs)
+    readBlocks(fs.disk, list(range(journal.start, journal.start + journal.nBlocks)), region)
+    magic, kind, tid = JOURNAL_BLOCK.unpack_from(region)[:3]
+    if((magic != JOURNAL_MAGIC) or (kind != JBLOCK_HEADER)):
+        tid = 1                             # Not a journal (yet), nothing to replay
+        transactions = []
     else:
-        extra_blocks = 0
-    superblock[2] = extra_blocks            # Write number of extra blocks needed
-
-    # Now write bitmap contiguously
-    full_bytes = int(floor(bitmap_len / 8))
-    leftover_bits = (bitmap_len % 8)
-    leftover_byte = 0
-    if(leftover_bits != 0):
-        for i in range(leftover_bits):
-            leftover_byte |= 1 << (7-i)
-
-    if(extra_blocks == 0):                  # Simple solution
-        for i in range(full_bytes):
-            superblock[HEADER_BYTES+i] = 0xFF
-        if(leftover_byte != 0):
-            superblock[HEADER_BYTES+full_bytes] = leftover_byte
-        writeBlock(disk, 0, superblock)     # Write superblock
-    else:                                   # We're gonna need more blocks
-        # Finish up superblock first
-        ind = HEADER_BYTES
-        while((full_bytes > 0) and (ind < BLOCKSIZE)):
-            superblock[ind] = 0xFF
-            full_bytes -= 1
-            ind += 1
-        writeBlock(disk, 0, superblock)
-
-        # Write extra block(s) as necessary
-        for i in range(extra_blocks):
-            extra_block = [0x00] * BLOCKSIZE
-            # Fill extra block
-            ind = 0
-            while((full_bytes > 0) and (ind < BLOCKSIZE)):
-                extra_block[ind] = 0xFF
-                full_bytes -= 1
-                ind += 1
-            if(ind < BLOCKSIZE):
-                extra_block[ind] = leftover_byte
-            # Write extra block
-            writeBlock(disk, 1+i, extra_block)
-    return extra_blocks
-    
+        transactions = journal_scan(journal, region, tid)
+
+    revoked = {}                            # bNum -> last tid that revoked it
+    for trans_tid, images, revokes in transactions:
+        for bNum in revokes:
+            revoked[bNum] = trans_tid
+    replay = {}                             # bNum -> newest image not revoked since
+    for trans_tid, images, revokes in transactions:
+        for bNum, image in images:
+            if(revoked.get(bNum, 0) < trans_tid):
+                replay[bNum] = image
+    if(len(replay) > 0):
+        bNums = sorted(replay)
+        buf = bytearray(len(bNums)*bs)
+        for i in range(len(bNums)):
+            buf[i*bs:(i+1)*bs] = replay[bNums[i]]
+        writeBlocks(fs.disk, bNums, buf)
+        flushDisk(fs.disk)
+    journal.tid = tid + len(transactions)
+    journal.committed = journal.written = journal.tid - 1
+    journal_reset(journal)
+    return len(transactions)
+
+def journal_scan(journal, region, tid):
+    # Parses the transactions in a journal region read off the disk, from tid on
+    # Returns a list of (tid, [(bNum, image), ...], [revoked bNum, ...]) of the complete ones, in order
+    bs = journal.fs.block_size
+    transactions = []
+    pos = 1
+    while(pos < journal.nBlocks):
+        images = []
+        revokes = []
+        block = pos
+        complete = False
+        while(block < journal.nBlocks):
+            magic, kind, block_tid, count = JOURNAL_BLOCK.unpack_from(region, block*bs)
+            if((magic != JOURNAL_MAGIC) or (block_tid != tid)):
+                break
+            listed = bnums_unpack(region[(block*bs)+JOURNAL_BLOCK.size:(block*bs)+JOURNAL_BLOCK.size+(
+                ADDR_SIZE*count)]) if(kind != JBLOCK_COMMIT) else []
+            if(any((bNum >= journal.fs.nBlocks) for bNum in listed)):
+                break
+            if(kind == JBLOCK_DESCRIPTOR):
+                if(block + 1 + count > journal.nBlocks):
+                    break
+                for i in range(count):
+                    images.append((listed[i], region[(block+1+i)*bs:(block+2+i)*bs]))
+                block += 1 + count
+            elif(kind == JBLOCK_REVOKE):
+                revokes.extend(listed)
+                block += 1
+            elif(kind == JBLOCK_COMMIT):
+                crc = int.from_bytes(region[(block*bs)+JOURNAL_BLOCK.size:(block*bs)+JOURNAL_BLOCK.size+4], 'big')
+                complete = ((count == block - pos) and (zlib.crc32(region[pos*bs:block*bs]) == crc))
+                block += 1
+                break
+            else:
+                break
+        if(not complete):
+            break
+        transactions.append((tid, images, revokes))
+        tid += 1
+        pos = block
+    return transactions
+
 def fill_bytes(block, byts, numByts, offset):
     # Fills given block with numByts bytes starting at given offset
     for i in range(numByts):
         block[offset+i] = byts[i]
 
-def find_freeblock(disk, extra_blocks):
-    # Finds a freeblock in the bitmap and returns its logical block number
-    # See if the bitmap has any available bits in superblock (bitmap != 0)
-    block = bytearray(BLOCKSIZE)
-    readBlock(disk, 0, block)
-    superblock_bitmap = block[HEADER_BYTES:]
-
-    found = -1
-    for i in range(len(superblock_bitmap)):
-        if(superblock_bitmap[i] > 0):           # Freeblock occurs in this byte
-            found_byte = superblock_bitmap[i]
-            found = i
-            foundBlock = 0
+def bitmap_load(fs):
+    # Reads the whole freeblock bitmap into fs.bitmap (one vectored read), so allocation never has to touch the disk
+    fs.bitmap = bytearray(fs.bitmap_blocks*fs.block_size)
+    readBlocks(fs.disk, list(range(1, 1+fs.bitmap_blocks)), fs.bitmap)
+    # Free count comes from the bitmap itself (metadata blocks and bits past the end of the disk are never set)
+    fs.free_blocks = bin(int.from_bytes(fs.bitmap, 'big')).count('1')
+    summary_build(fs)
+    fs.bitmap_cursor = fs.data_start
+    fs.bitmap_dirty = set()
+
+def bitmap_sync(fs):
+    # Writes back every bitmap block changed since the last sync, once each (contiguous ones together)
+    with fs.alloc_lock:
+        if(len(fs.bitmap_dirty) == 0):
+            return
+        bs = fs.block_size
+        dirty = sorted(fs.bitmap_dirty)
+        region = bytearray(len(dirty)*bs)
+        for i in range(len(dirty)):
+            region[i*bs:(i+1)*bs] = fs.bitmap[dirty[i]*bs:(dirty[i]+1)*bs]
+        if(fs.journal is not None):         # Blocks freed but not reusable yet are free on disk (see journal_free)
+            with fs.journal.lock:
+                freed = fs.journal.freeing + fs.journal.to_free
+                for committing in fs.journal.committing.values():
+                    freed.extend(committing)
+            pos = {dirty[i]: i for i in range(len(dirty))}
+            for bNum in freed:
+                i = pos.get(bitmap_locate(fs, bNum))
+                if(i is not None):
+                    bit = bNum - (dirty[i]*8*bs)
+                    region[(i*bs) + (bit >> 3)] |= 1 << (7 - (bit & 7))
+        meta_writes(fs, [1+bitmap_block for bitmap_block in dirty], region)
+        fs.bitmap_dirty.clear()
+
+def bitmap_scan(bitmap, start, end):
+    # Returns the index of the first set (free) bit in [start, end), or -1
+    # Works a whole word (BITMAP_SCAN_BYTES) at a time: the highest set bit of the word is the first free block
+    pos = start
+    while(pos < end):
+        byte = pos >> 3
+        chunk = bitmap[byte:byte+BITMAP_SCAN_BYTES]
+        width = 8*len(chunk)
+        word = int.from_bytes(chunk, 'big')
+        word &= (1 << (width - (pos & 7))) - 1  # Ignore bits before pos
+        if(word):
+            bit = (byte << 3) + width - word.bit_length()
+            if(bit < end):
+                return bit
+            return -1
+        pos = (byte << 3) + width
+    return -1
+
+def bitmap_scan_clear(bitmap, start, end):
+    # Returns the index of the first clear (used) bit in [start, end), or end if they're all free
+    pos = start
+    while(pos < end):
+        byte = pos >> 3
+        chunk = bitmap[byte:byte+BITMAP_SCAN_BYTES]
+        width = 8*len(chunk)
+        if(width == 0):
             break
-    
-    # Check if freeblock was found
-    if(found < 0):
-        if(extra_blocks < 1):
-            return ERR_NO_FREEBLOCKS
-        
-        # Check other bitmap block(s)
-        for i in range(extra_blocks):
-            readBlock(disk, 1+i, block)
-            bitmap_block = bytearray(block)
-            for j in range(len(bitmap_block)):
-                if(bitmap_block[j] > 0):
-                    found_byte = bitmap_block[j]
-                    found = j
-                    foundBlock = i
-                    break
-        
-    if(found < 0):
+        word = int.from_bytes(chunk, 'big') ^ ((1 << width) - 1)
+        word &= (1 << (width - (pos & 7))) - 1  # Ignore bits before pos
+        if(word):
+            return min((byte << 3) + width - word.bit_length(), end)
+        pos = (byte << 3) + width
+    return end
+
+def summary_build(fs):
+    # Builds the summary levels over the bitmap: bit i of a level is set iff word i (SUMMARY_FANOUT bits) of the
+    #   level below has a free bit. Levels are added until one fits in a single word, so finding a free block
+    #   looks at a word or two per level instead of scanning the whole bitmap.
+    fs.bitmap_summary = []
+    level = fs.bitmap
+    empty = bytes(BITMAP_SCAN_BYTES)
+    while(8*len(level) > SUMMARY_FANOUT):
+        nWords = int(ceil(len(level) / float(BITMAP_SCAN_BYTES)))
+        above = bytearray(int(ceil(nWords / 8.0)))
+        for word in range(nWords):
+            if(level[word*BITMAP_SCAN_BYTES:(word+1)*BITMAP_SCAN_BYTES].strip(b'\x00')):
+                above[word >> 3] |= 1 << (7 - (word & 7))
+        fs.bitmap_summary.append(above)
+        level = above
+
+def summary_update(fs, first, last):
+    # Brings the summary levels back in line after bits first..last (inclusive) of the bitmap changed
+    level = fs.bitmap
+    for above in fs.bitmap_summary:
+        first //= SUMMARY_FANOUT
+        last //= SUMMARY_FANOUT
+        for word in range(first, last+1):
+            mask = 1 << (7 - (word & 7))
+            if(level[word*BITMAP_SCAN_BYTES:(word+1)*BITMAP_SCAN_BYTES].strip(b'\x00')):
+                above[word >> 3] |= mask
+            else:
+                above[word >> 3] &= ~mask
+        level = above
+
+def summary_find(fs, start, depth=0):
+    # Returns the first free bit at or after start in summary level depth (0 = the bitmap itself), or -1
+    # Only the word holding start is scanned; past it, the level above says which word to look in next
+    levels = [fs.bitmap] + fs.bitmap_summary
+    level = levels[depth]
+    nbits = 8*len(level)
+    if(start >= nbits):
+        return -1
+    if(depth == len(levels)-1):             # Top level is a single word
+        return bitmap_scan(level, start, nbits)
+    word = start // SUMMARY_FANOUT
+    bit = bitmap_scan(level, start, min((word+1)*SUMMARY_FANOUT, nbits))
+    if(bit >= 0):
+        return bit
+    word = summary_find(fs, word+1, depth+1)
+    if(word < 0):
+        return -1
+    return bitmap_scan(level, word*SUMMARY_FANOUT, min((word+1)*SUMMARY_FANOUT, nbits))
+
+def bitmap_next_run(fs, start, cap, end=None):
+    # Returns the first free run in [start, end) as (first bit, length), or None
+    # The run is only measured up to cap bits, so the cost doesn't depend on how big the free run really is
+    if(end is None):
+        end = fs.nBlocks
+    bit = summary_find(fs, start)
+    if((bit < 0) or (bit >= end)):
+        return None
+    return (bit, bitmap_scan_clear(fs.bitmap, bit, min(bit+cap, end)) - bit)
+
+def bitmap_mark(fs, bit, length, free):
+    # Sets (free=True) or clears a run of bits, a byte at a time where the run covers whole bytes
+    # The run must currently be entirely in the opposite state
+    end = bit + length
+    pos = bit
+    while((pos < end) and (pos & 7)):       # Leading bits up to a byte boundary
+        mask = 1 << (7 - (pos & 7))
+        fs.bitmap[pos >> 3] = (fs.bitmap[pos >> 3] | mask) if free else (fs.bitmap[pos >> 3] & ~mask)
+        pos += 1
+    nBytes = (end - pos) >> 3
+    if(nBytes > 0):                         # Whole bytes in the middle
+        fs.bitmap[pos >> 3:(pos >> 3) + nBytes] = (b'\xff' if free else b'\x00') * nBytes
+        pos += nBytes << 3
+    while(pos < end):                       # Trailing bits
+        mask = 1 << (7 - (pos & 7))
+        fs.bitmap[pos >> 3] = (fs.bitmap[pos >> 3] | mask) if free else (fs.bitmap[pos >> 3] & ~mask)
+        pos += 1
+    fs.free_blocks += length if free else -length
+    summary_update(fs, bit, end - 1)
+    for bitmap_block in range(bitmap_locate(fs, bit), bitmap_locate(fs, end - 1) + 1):
+        fs.bitmap_dirty.add(bitmap_block)
+
+def bitmap_locate(fs, bit):
+    # Bitmap block (0 = first block of the bitmap region) holding a block's bit
+    return int(bit / (8*fs.block_size))
+
+def alloc_extents(fs, nBlocks):
+    # Allocates nBlocks data blocks as a list of extents [(first block number, length), ...] using as few
+    #   contiguous runs as possible, and marks them as used in the bitmap
+    # Next-fit: the first free run from the cursor on (wrapping around) that holds the whole request wins.
+    #   Only the first ALLOC_SEARCH_RUNS runs are looked at for that; if none is big enough, the largest of
+    #   them are taken first, then whatever runs come next.
+    if(nBlocks > fs.free_blocks):
         return ERR_NO_FREEBLOCKS
-        
-    # Find bit in byte for freeblock
-    bitNum = -1
-    for i in range(8):
-        if((found_byte & (1 << (7-i))) > 0):
-            bitNum = i
+    if(nBlocks <= 0):
+        return []
+    cursor = min(max(fs.bitmap_cursor, fs.data_start), fs.nBlocks)
+    runs = []
+    pos = cursor
+    wrapped = False
+    while(len(runs) < ALLOC_SEARCH_RUNS):
+        # Once wrapped, stop at the cursor (where the search started)
+        run = bitmap_next_run(fs, pos, nBlocks, cursor if wrapped else None)
+        if(run is None):
+            if(wrapped):
+                break
+            wrapped = True
+            pos = fs.data_start
+            continue
+        if(run[1] >= nBlocks):
+            runs = [run]
+            break
+        runs.append(run)
+        pos = run[0] + run[1]
+
+    chosen = []
+    needed = nBlocks
+    for bit, length in sorted(runs, key=lambda run: run[1], reverse=True):
+        chosen.append((bit, min(length, needed)))
+        needed -= chosen[-1][1]
+        if(needed == 0):
             break
-    if(bitNum < 0):
+    for bit, length in chosen:
+        bitmap_mark(fs, bit, length, False)
+    while(needed > 0):                      # Rare: lots of tiny runs, take them in disk order
+        run = bitmap_next_run(fs, pos, needed)
+        if(run is None):
+            run = bitmap_next_run(fs, fs.data_start, needed)
+        bitmap_mark(fs, run[0], run[1], False)
+        chosen.append(run)
+        needed -= run[1]
+        pos = run[0] + run[1]
+    fs.bitmap_cursor = chosen[-1][0] + chosen[-1][1]
+    return chosen
+
+def find_freeblock(fs):
+    # Finds a freeblock in the resident bitmap and returns its block number
+    # Next-fit: search from just past the last allocation, then wrap around to the start
+    bit = summary_find(fs, fs.bitmap_cursor)
+    if(bit < 0):
+        bit = summary_find(fs, fs.data_start)
+    if(bit < 0):
         return ERR_NO_FREEBLOCKS
+    fs.bitmap_cursor = bit+1
+    return bit
 
-    # Freeblock found, find corresponding bNum
-    if(foundBlock != 0):
-        # Adjust first block to be first block of block with bitmap
-        first_block = DATA_REGION_START + ((BLOCKSIZE - HEADER_BYTES)*8) + (BLOCKSIZE*8*foundBlock)
-    else:
-        first_block = DATA_REGION_START
-
-    return first_block + (found*8) + bitNum
-
-def remove_freeblock(disk, bNum, extra_blocks):
+def remove_freeblock(fs, bNum):
     # Given the block number, set corresponding bit in bitmap to 0
-    bNum_adjusted = bNum - DATA_REGION_START     # First bit in bitmap = first FREE block
-    byteNum = int(floor(bNum_adjusted / 8))
-    bitNum = bNum_adjusted % 8
-
-    # Find which bitmap block our old freeblock was on
-    leftover_bytes = BLOCKSIZE-HEADER_BYTES     # How many bytes are left for bitmap in superblock
-    if(byteNum >= leftover_bytes):              # freeblock is on one of the extra blocks
-        bitmap_block = 1+int(floor((byteNum-leftover_bytes) / BLOCKSIZE))
-    else:
-        bitmap_block = 0
-    
-    # Read in block from disk
-    diskBlock = bytearray(BLOCKSIZE)
-    readBlock(disk, bitmap_block, diskBlock)
-
-    # Alter block by setting bit from bitmap to 0
-    diskBlock[HEADER_BYTES+byteNum] = diskBlock[HEADER_BYTES+byteNum] & ~(1 << (7-bitNum))
-
-    # Write altered block back onto disk
-    writeBlock(disk, bitmap_block, diskBlock)
-
-
-def add_freeblock(disk, bNum, extra_blocks):
+    byteNum = bNum >> 3
+    mask = 1 << (7 - (bNum & 7))
+    if(fs.bitmap[byteNum] & mask):
+        fs.bitmap[byteNum] &= ~mask
+        fs.free_blocks -= 1
+        summary_update(fs, bNum, bNum)
+        fs.bitmap_dirty.add(bitmap_locate(fs, bNum))
+
+def add_freeblock(fs, bNum):
     # Given the block number, set corresponding bit in bitmap to 1
-    bNum_adjusted = bNum - DATA_REGION_START     # First bit in bitmap = first FREE block
-    byteNum = int(floor(bNum_adjusted / 8))
-    bitNum = bNum_adjusted % 8
-
-    # Find which bitmap block our old freeblock was on
-    leftover_bytes = BLOCKSIZE-HEADER_BYTES     # How many bytes are left for bitmap in superblock
-    if(byteNum >= leftover_bytes):              # freeblock is on one of the extra blocks
-        bitmap_block = 1+int(floor((byteNum-leftover_bytes) / BLOCKSIZE))
-    else:
-        bitmap_block = 0
-    
-    # Read in block from disk
-    diskBlock = bytearray(BLOCKSIZE)
-    readBlock(disk, bitmap_block, diskBlock)
-
-    # Alter block by setting bit from bitmap to 1
-    diskBlock[HEADER_BYTES+byteNum] = diskBlock[HEADER_BYTES+byteNum] | (1 << (7-bitNum))
-
-    # Write altered block back onto disk
-    writeBlock(disk, bitmap_block, diskBlock)
-
-def create_inode(mode, size, bNums):
-    # Creates an inode block, containing:
-    #   File type (mode), size (in bytes), blocks (allocated in memory), last access time, creation time
-    #   Note: bNums is an array of 4-byte logical block numbers for the file's data blocks
-    if(len(bNums) > MAX_DBLOCKS):
-        return ERR_FILE_TOO_LARGE
-
-    inode = bytearray(BLOCKSIZE)
-    # Start with file type
-    for i in range(2):
-        inode[1-i] = (mode & (0xFF << (8*i))) >> (8*i)
-    # Then size
-    for i in range(2):
-        inode[(1+2)-i] = (size & (0xFF << (8*i))) >> (8*i)
-    # Number of blocks allocated
-    for i in range(2):
-        inode[(1+4+2)-i] = (len(bNums) & (0xFF << (8*i))) >> (8*i)
-    # Now creation, access, and modify times, which will start out all the same
-    times = int(time.time())
-    for i in range(3):
-        for j in range(4):
-            inode[(1+4+2+4+(4*i))-j] = (times & (0xFF << (8*j))) >> (8*j)
-    
-    # That takes up all the metadata, now for the data block locations
-    # In the form of a list of blocks
-    for i in range(len(bNums)):
-        for j in range(4):
-            inode[INODE_METADATA+(i*4)+3-j] = (bNums[i] & (0xFF << (8*j))) >> (8*j)
-    return inode
+    # With a journal it's only set in memory once the transaction freeing it has committed, see journal_free
+    if(fs.journal is not None):
+        journal_free(fs.journal, bNum)
+        return
+    byteNum = bNum >> 3
+    mask = 1 << (7 - (bNum & 7))
+    if(not (fs.bitmap[byteNum] & mask)):
+        fs.bitmap[byteNum] |= mask
+        fs.free_blocks += 1
+        summary_update(fs, bNum, bNum)
+        fs.bitmap_dirty.add(bitmap_locate(fs, bNum))
 
 def convert_time(epoch_time):
     # Converts time since epoch to calendar data + clock time
@@ -724,8 +2433,7 @@ def convert_time(epoch_time):
 
 def get_offset(FD):
     # Helper function for tinyFSDemo
-    global curr_FS
-    return curr_FS.files[FD].offset
+    return default_handle.fs.files[FD].offset
 
 
 
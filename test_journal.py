@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Crash tests for the metadata journal: a child process works on a disk and dies (os._exit, no unmount), then
+#   the disk is mounted again (replaying the journal) and the bitmap checked against the blocks the inodes use,
+#   along with the contents of files the workload expects to find
+# Run with 'python3 -m unittest test_journal' (or pytest)
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+import libTinyFS
+from constants import *
+
+DISK_SIZE = 1 << 21
+
+# Child process prelude: makes the FS and mounts it, the test adds the workload after it
+CHILD = """
+import os, sys, random, time
+sys.path.insert(0, %r)
+import libTinyFS
+path = %r
+assert libTinyFS.tfs_mkfs(path, %d) == 0
+h = libTinyFS.TinyFS.mount(path)
+"""
+
+class JournalCrashTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'crashFS')
+
+    def tearDown(self):
+        libTinyFS.filesystems.pop(self.path, None)
+        self.dir.cleanup()
+
+    def crash(self, workload):
+        # Runs workload in a child process on a new FS, then has it exit without unmounting
+        here = os.path.dirname(os.path.abspath(__file__))
+        code = (CHILD % (here, self.path, DISK_SIZE)) + textwrap.dedent(workload) + "\nos._exit(0)\n"
+        child = subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True, text=True,
+            timeout=300)
+        self.assertEqual(child.returncode, 0, child.stderr)
+
+    def check_bitmap(self, files=None):
+        # Mounts the crashed disk and checks every block is either free or used by exactly one inode (or the
+        #   superblock, bitmap, inode table or journal), never both or neither, and that files (name -> bytes)
+        #   hold what they should
+        h = libTinyFS.TinyFS.mount(self.path)
+        self.assertIsInstance(h, libTinyFS.TinyFS)
+        for name, data in (files or {}).items():
+            FD = h.open(name)
+            self.assertGreaterEqual(FD, 0, name)
+            self.assertEqual(h.read(FD, len(data) + 1), data, name)
+        fs = h.fs
+        used = set(range(fs.table_start)) | set(fs.table_blocks)
+        used |= set(range(fs.journal_start, fs.journal_start + fs.journal_blocks))
+        inodes = [bNum for name, bNum in fs.slots.values()] + [fs.root]
+        for bNum in inodes:
+            inode = libTinyFS.inode_load(fs, bNum)
+            for block in [bNum] + list(inode.blocks) + list(inode.ptrs):
+                self.assertNotIn(block, used)
+                used.add(block)
+        for bNum in range(fs.nBlocks):
+            free = bool(fs.bitmap[bNum >> 3] & (1 << (7 - (bNum & 7))))
+            self.assertNotEqual(free, bNum in used, "block %d is %s" % (bNum, "free and used" if(free) else "leaked"))
+        self.assertEqual(h.unmount(), SUCCESS)
+
+    def test_delete_then_fsync_other(self):
+        # The delete's frees go out with the commit fsync on another file waits for
+        self.crash("""
+            fd = h.open('big')
+            data = os.urandom(40 * 256)
+            assert h.write(fd, data, len(data)) == 0
+            other = h.open('other')
+            assert h.delete(fd) == 0
+            assert h.fsync(other) == 0
+        """)
+        self.check_bitmap()
+
+    def test_crash_mid_workload(self):
+        self.crash("""
+            r = random.Random(1)
+            h.mkdir('d')
+            for i in range(300):
+                fd = h.open('d/f%d' % r.randrange(10))
+                op = r.randrange(3)
+                if(op == 0):
+                    data = os.urandom(r.randrange(1, 40) * 256)
+                    assert h.write(fd, data, len(data)) == 0
+                elif(op == 1):
+                    assert h.delete(fd) == 0
+                else:
+                    h.fsync(fd)
+        """)
+        self.check_bitmap()
+
+    def test_data_before_metadata(self):
+        # The new file's inode commits without an fsync while its data is still in the write-back cache. It gets
+        #   the deleted file's blocks, so the commit has to write the data first or those bytes show through.
+        self.crash("""
+            n = 0
+            while(h.fs.free_blocks > 150):      # Fill the disk, leaving room for about 70 blocks
+                fd = h.open('fill%d' % n)
+                data = bytes(min(3000, h.fs.free_blocks - 100) * 256)
+                assert h.write(fd, data, len(data)) == 0
+                n += 1
+            fd = h.open('secret')
+            assert h.write(fd, b'S' * 10240, 10240) == 0
+            assert h.fsync(fd) == 0
+            assert h.delete(fd) == 0
+            fd = h.open('newfile')
+            assert h.write(fd, b'N' * 10240, 10240) == 0
+            time.sleep(0.1)                     # Committed, but well short of the flusher's expiry
+        """)
+        self.check_bitmap({'newfile': b'N' * 10240})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -111,7 +111,7 @@ def test_FS():
     tfs_delete(fd_hello)
     results = tfs_readByte(fd_hello, buff)
     print("\n --- Results of trying to read from deleted file ---\n",
-        "Return Values: 0 for Success, -15 for expected Error (ERR_INVALID_READ)\n",
+        "Return Values: 0 for Success, -10 for expected Error (ERR_INVALID_FD)\n",
         "Results: {}\n".format(results))
 
 